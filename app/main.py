@@ -25,14 +25,20 @@ logging.basicConfig(
 log = logging.getLogger("app.main")
 
 # Routers & services
-from app.routers import ingest, query, upload, files, search
-from app.services import vectorstore, config
+from app.routers import ingest, query, upload, files, search, jobs as jobs_router, llm_stub
+from app.services import vectorstore, answer_cache, cache, compress, config, embeddings, llm, pdf_extract, jobs, rerank
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        vectorstore.rebuild_bm25_index()
-        log.info("[startup] BM25 index built.")
+        vectorstore.open_bm25_index()
+        log.info("[startup] BM25 index ready.")
+        vectorstore.open_docstore()
+        log.info("[startup] Docstore ready.")
+        answer_cache.get_cache()  # load persisted answers, start listening for corpus changes
+        rerank.warmup()  # load the cross-encoder outside the per-query budget
+        jobs.start()
+        log.info("[startup] Ingest job workers started (%d).", max(1, config.ENV.JOB_WORKERS))
         log.info(
             "[startup] Chroma dir=%s | collection=%s | embed_model=%s | llm_provider=%s | openai_model=%s",
             str(config.VECTOR_DIR),
@@ -44,6 +50,9 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         log.exception("[startup] init failed: %s", e)
     yield
+    jobs.stop()
+    pdf_extract.shutdown_pool()
+    llm.shutdown()
     log.info("[shutdown] Bye.")
 
 app = FastAPI(
@@ -81,6 +90,8 @@ def root():
             "upload": "/api/upload",
             "ingest": "/api/ingest",
             "ingest_stream": "/api/ingest/stream",
+            "jobs": "/api/jobs",
+            "job_status": "/api/jobs/{id}",
             "query": "/api/query",
             "search": "/api/search",
             "files_list": "/api/pdfs",
@@ -104,8 +115,13 @@ def info():
             "sample": sources,
         },
         "embedding_model": config.ENV.EMBED_MODEL,
-        "llm": {"provider": (config.ENV.LLM_PROVIDER or "openai"),
-                "model": getattr(config.ENV, "OPENAI_MODEL", "gpt-4o-mini")},
+        "embedding_batcher": embeddings.batcher_stats(),
+        "reranker": {"model": config.ENV.RERANKER_MODEL, **rerank.stats()},
+        "compression": compress.stats(),
+        "caches": {**cache.all_stats(), "answers": answer_cache.stats()},
+        "coalescing": cache.flight_stats(),
+        "corpus_version": vectorstore.corpus_version(),
+        "llm": llm.stats(),
         "chunking": {"tokens": config.ENV.CHUNK_TOKENS, "overlap": config.ENV.CHUNK_OVERLAP},
     }
 
@@ -118,7 +134,10 @@ app.include_router(ingest.router)                 # has internal prefix="/api"
 app.include_router(query.router)                  # prefix="/api"
 app.include_router(upload.router)                 # prefix="/api"
 app.include_router(files.router)                  # prefix="/api"
+app.include_router(jobs_router.router)            # prefix="/api"
 app.include_router(search.router, prefix="/api")  # search had no internal prefix
+if config.ENV.LLM_STUB_ROUTE:
+    app.include_router(llm_stub.router)           # prefix="/v1", offline chat-completions stub
 
 
 
@@ -17,7 +17,19 @@ class QueryRequest(BaseModel):
     stream: Optional[bool] = Field(None, description="SSE streaming")
     top_k: int = Field(5, ge=1, le=20)
     max_context_chars: int = Field(6000, ge=500, le=20000)
+    max_context_tokens: Optional[int] = Field(
+        None, ge=128, le=32000, description="Context budget in tokens (overrides max_context_chars)"
+    )
+    compress: Optional[bool] = Field(
+        None, description="Cut snippets to their query-relevant sentences (default: CONTEXT_COMPRESS)"
+    )
     filter_doc: Optional[str] = Field(None, description="Filter by source filename (optional)")
+    filters: Optional[Dict[str, Any]] = Field(
+        None, description="Optional filters on source/page/language; values may be lists"
+    )
+    fusion: Optional[Dict[str, Any]] = Field(
+        None, description="Per-request fusion overrides: strategy (weighted|rrf), w_dense, w_bm25, rrf_k"
+    )
 
     @model_validator(mode="after")
     def _normalize(self):
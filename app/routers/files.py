@@ -3,7 +3,7 @@ from __future__ import annotations
 from pathlib import Path
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
-from ..services import config, vectorstore
+from ..services import config, ingest_service
 
 router = APIRouter(prefix="/api", tags=["files"])
 
@@ -32,5 +32,5 @@ def delete_pdf(filename: str):
     if not path.exists():
         raise HTTPException(404, f"{filename} not found")
     path.unlink()
-    removed = vectorstore.delete_by_source(filename)
+    removed = ingest_service.forget(filename)
     return JSONResponse({"deleted": filename, "vectors_removed": removed})
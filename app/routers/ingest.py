@@ -3,31 +3,26 @@ from __future__ import annotations
 import json
 import logging
 import time
-from typing import Iterator, List, Tuple
+from typing import Iterator
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse, StreamingResponse
-from ..services import ingest_service, config
+from ..services import ingest_service, config, jobs
 
 router = APIRouter(prefix="/api", tags=["ingest"])
 log = logging.getLogger(__name__)
 
 @router.post("/ingest")
-def ingest_all():
-    started = time.time()
-    results: List[Tuple[str, int]] = ingest_service.ingest_all_pdfs()
-    total = sum(cnt for _, cnt in results)
-    payload = [{"filename": name, "chunks_upserted": cnt} for (name, cnt) in results]
-    return JSONResponse({
-        "success": True,
-        "ingested": payload,
-        "total_chunks": total,
-        "file_count": len(payload),
-        "took_seconds": round(time.time() - started, 3),
-    })
+def ingest_all(force: bool = False, priority: int = 0):
+    """Queue a full-corpus ingest; poll /api/jobs/{id} for progress."""
+    job = jobs.submit("ingest_all", {"force": force}, priority=priority)
+    return JSONResponse({"success": True, "job": job}, status_code=202)
 
 @router.get("/ingest/stream")
 def ingest_stream() -> StreamingResponse:
     def gen() -> Iterator[str]:
+        for name, removed in ingest_service.prune_deleted():
+            yield "event: file\n"
+            yield f"data: {json.dumps({'type':'file_removed','filename':name,'chunks_removed':removed})}\n\n"
         files = sorted(config.SOURCE_PDFS.glob("*.pdf"))
         if not files:
             yield "event: status\n"
@@ -0,0 +1,27 @@
+# app/routers/jobs.py
+from __future__ import annotations
+from typing import Optional
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+from ..services import jobs
+
+router = APIRouter(prefix="/api", tags=["jobs"])
+
+@router.get("/jobs")
+def list_jobs(status: Optional[str] = None, limit: int = 50):
+    return JSONResponse({"jobs": jobs.list_jobs(status=status, limit=max(1, min(limit, 500)))})
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return JSONResponse(job)
+
+@router.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    if jobs.get(job_id) is None:
+        raise HTTPException(404, "Job not found")
+    if not jobs.cancel(job_id):
+        raise HTTPException(409, "Job already started")
+    return JSONResponse({"success": True, "id": job_id, "status": "cancelled"})
@@ -0,0 +1,55 @@
+# app/routers/llm_stub.py
+from __future__ import annotations
+import asyncio
+import json
+import time
+import uuid
+from typing import AsyncIterator
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, StreamingResponse
+from ..services import config, llm
+
+# Minimal OpenAI chat-completions endpoint backed by llm.stub_reply, mounted
+# when LLM_STUB_ROUTE=true. Pointing OPENAI_BASE_URL at <host>/v1 load-tests
+# the real client path (pool, retries, hedging, streaming) fully offline.
+router = APIRouter(prefix="/v1", tags=["llm-stub"])
+
+def _chunk(cid: str, model: str, delta: dict, finish: str | None = None) -> str:
+    body = {
+        "id": cid,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return f"data: {json.dumps(body)}\n\n"
+
+@router.post("/chat/completions")
+async def chat_completions(req: dict):
+    model = req.get("model") or config.ENV.OPENAI_MODEL
+    deltas = llm.stub_reply(req.get("messages") or [])
+    cid = f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"
+    ttft, per_token = config.ENV.LLM_STUB_TTFT_MS / 1000.0, config.ENV.LLM_STUB_TOKEN_MS / 1000.0
+
+    if req.get("stream"):
+        async def gen() -> AsyncIterator[str]:
+            await asyncio.sleep(ttft)
+            yield _chunk(cid, model, {"role": "assistant", "content": ""})
+            for i, d in enumerate(deltas):
+                if i:
+                    await asyncio.sleep(per_token)
+                yield _chunk(cid, model, {"content": d})
+            yield _chunk(cid, model, {}, finish="stop")
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    await asyncio.sleep(ttft + per_token * max(0, len(deltas) - 1))
+    text = "".join(deltas)
+    return JSONResponse({
+        "id": cid,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(deltas), "total_tokens": len(deltas)},
+    })
@@ -1,21 +1,80 @@
 # app/routers/query.py
 from __future__ import annotations
-from fastapi import APIRouter
+import asyncio
+import json
+import logging
+import threading
+from typing import AsyncIterator, Dict
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import JSONResponse
-from ..services import rag_service
+from sse_starlette.sse import EventSourceResponse
+from ..services import fusion, llm, rag_service, vectorstore
 
 router = APIRouter(prefix="/api", tags=["query"])
+log = logging.getLogger(__name__)
+
+async def _stream(kwargs: Dict) -> AsyncIterator[Dict]:
+    """Run rag_service.answer_stream on a worker thread and relay its events.
+    When the client disconnects, sse-starlette cancels this generator and
+    the ``finally`` closes the upstream LLM response, even mid-connect or
+    before its first token."""
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    cancel = llm.CancelToken()
+
+    def _emit(item) -> None:
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, item)
+        except RuntimeError:  # loop already closed
+            cancel.set()
+
+    def pump() -> None:
+        try:
+            for item in rag_service.answer_stream(cancel=cancel, **kwargs):
+                if cancel.is_set():
+                    break
+                _emit(item)
+        except Exception as e:
+            log.exception("Streaming answer failed")
+            _emit(("error", {"detail": str(e)}))
+        finally:
+            _emit(None)
+
+    threading.Thread(target=pump, name="answer-stream", daemon=True).start()
+    try:
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            event, data = item
+            yield {"event": event, "data": json.dumps(data)}
+    finally:
+        cancel.set()
 
 @router.post("/query")
 def query(req: dict):
     q = req.get("query") or req.get("question") or ""
     top_k = int(req.get("top_k", 10))
     max_context_chars = int(req.get("max_context_chars", 6000))
+    max_context_tokens = req.get("max_context_tokens")
     filter_doc = req.get("filter_doc")
-    result = rag_service.answer(
+    try:
+        filters = vectorstore.make_filters(req.get("filters"))
+        fusion.params(req.get("fusion"))  # validate per-request overrides
+    except (TypeError, ValueError) as e:
+        raise HTTPException(400, str(e))
+    kwargs = dict(
         query=q,
         top_k=top_k,
         max_context_chars=max_context_chars,
         filter_doc=filter_doc,
+        filters=filters,
+        fusion_opts=req.get("fusion"),
+        max_context_tokens=int(max_context_tokens) if max_context_tokens else None,
+        compress_context=req.get("compress"),
     )
+    if req.get("stream"):
+        # events: citations -> token* -> meta (or error)
+        return EventSourceResponse(_stream(kwargs))
+    result = rag_service.answer(**kwargs)
     return JSONResponse(result)
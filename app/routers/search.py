@@ -1,9 +1,9 @@
 # app/routers/search.py
 from __future__ import annotations
-from typing import List
-from fastapi import APIRouter
+from typing import List, Tuple
+from fastapi import APIRouter, HTTPException
 from fastapi.responses import JSONResponse
-from ..services import vectorstore, config
+from ..services import cache, fusion, rag_service, vectorstore, config
 
 router = APIRouter(tags=["search"])
 
@@ -11,8 +11,28 @@ router = APIRouter(tags=["search"])
 def search(req: dict):
     q = req.get("query", "")
     top_k = int(req.get("top_k", 10))
-    hits = vectorstore.hybrid_search(q, topk_dense=config.ENV.TOPK_DENSE, topk_bm25=config.ENV.TOPK_BM25)
-    hits = vectorstore.mmr_diverse(hits, top_k=top_k, lambda_mult=config.ENV.MMR_LAMBDA)
+    try:
+        filters = vectorstore.make_filters(req.get("filters"), source=req.get("filter_doc"))
+        fp = fusion.params(req.get("fusion"))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(400, str(e))
+    results = cache.get_cache("retrieval", config.ENV.QUERY_CACHE_MB)
+    key = ("search", cache.normalize_query(q), top_k, vectorstore.filter_key(filters), fp.key())
+    version = vectorstore.corpus_version()
+    cached = results.get(key, version)
+    if cached is not None:
+        return JSONResponse({"results": cached})
+    # identical concurrent searches share one computation
+    out, degraded = cache.get_flight("search").do((key, version), lambda: _search(q, top_k, filters, fp))
+    if not degraded:  # don't pin a fused-order fallback until the corpus changes
+        results.put(key, out, version)
+    return JSONResponse({"results": out})
+
+def _search(q: str, top_k: int, filters, fp) -> Tuple[List[dict], bool]:
+    hits = vectorstore.hybrid_search(q, topk_dense=config.ENV.TOPK_DENSE, topk_bm25=config.ENV.TOPK_BM25,
+                                     filters=filters, fusion_params=fp)
+    hits.sort(key=lambda h: h.score, reverse=True)
+    hits, degraded = rag_service.diversify(q, hits, top_k=top_k)
     out: List[dict] = []
     for h in hits:
         out.append({
@@ -20,7 +40,7 @@ def search(req: dict):
             "page": h.page,
             "score_vec": h.score_vec,
             "score_bm25": h.score_bm25,
+            "score": h.score,
             "snippet": (h.text[:400] + "...") if len(h.text) > 400 else h.text,
         })
-    return JSONResponse({"results": out})
-
+    return out, degraded
@@ -1,21 +1,113 @@
 # app/routers/upload.py
 from __future__ import annotations
-from typing import List
+from typing import Dict, List, Tuple
 from pathlib import Path
-from fastapi import APIRouter, UploadFile, File
+import hashlib
+import logging
+import os
+import uuid
+from fastapi import APIRouter, HTTPException, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
-from ..services import config, ingest_service
+from ..services import config, jobs, manifest
 
 router = APIRouter(prefix="/api", tags=["upload"])
+log = logging.getLogger(__name__)
+
+async def _spool(f: UploadFile) -> Tuple[Path, str]:
+    """Stream ``f`` into a temp file in SOURCE_PDFS in fixed-size chunks,
+    hashing as it goes. Returns (temp path, sha256)."""
+    size = max(64 * 1024, config.ENV.UPLOAD_CHUNK_BYTES)
+    tmp = Path(config.SOURCE_PDFS) / f".upload-{uuid.uuid4().hex}.part"  # not matched by *.pdf scans
+    h = hashlib.sha256()
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                data = await f.read(size)
+                if not data:
+                    break
+                h.update(data)
+                await run_in_threadpool(out.write, data)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return tmp, h.hexdigest()
+
+class _Busy(Exception):
+    """The target name is referenced by a queued or running ingest job."""
+
+def _busy(name: str) -> bool:
+    return (Path(config.SOURCE_PDFS) / name).exists() and jobs.file_busy(name)
+
+def _place(tmp: Path, name: str, sha: str) -> str | None:
+    """
+    Move an uploaded temp file into SOURCE_PDFS unless its content is
+    already ingested or queued by another upload. Returns the name the
+    content is (or will be) ingested under, or None when it is new; the
+    caller then owns an upload claim on ``sha`` until the ingest job runs.
+    Raises _Busy instead of overwriting a file an ingest job is reading.
+    """
+    src = Path(config.SOURCE_PDFS)
+    dest = src / name
+    if _busy(name):
+        tmp.unlink(missing_ok=True)
+        raise _Busy(name)
+    known = manifest.find_by_sha256(sha)
+    if name in known:
+        # re-upload of an ingested file: refresh size/mtime so scans skip it without hashing
+        os.replace(tmp, dest)
+        st = dest.stat()
+        manifest.touch(name, st.st_size, st.st_mtime)
+        return name
+    # same bytes under another name; keep one copy, unless that copy was deleted
+    dup = next((n for n in known if (src / n).exists()), None)
+    if dup is None:
+        dup = manifest.claim_upload(sha, name)  # in flight from a concurrent upload?
+    if dup is not None:
+        tmp.unlink(missing_ok=True)
+        return dup
+    try:
+        os.replace(tmp, dest)  # atomic: scans never see a half-written PDF
+    except BaseException:
+        manifest.release_upload(sha, name)
+        raise
+    return None
 
 @router.post("/upload")
-async def upload(files: List[UploadFile] = File(...)):
-    saved = []
-    for f in files:
-        dest = Path(config.SOURCE_PDFS) / f.filename
-        data = await f.read()
-        dest.write_bytes(data)
-        saved.append(f.filename)
-    # auto-ingest the newly uploaded files
-    counts = ingest_service.ingest_specific_files([Path(config.SOURCE_PDFS) / s for s in saved])
-    return JSONResponse({"uploaded": saved, "ingested": [{"filename": n, "chunks_upserted": c} for (n, c) in counts]})
+async def upload(files: List[UploadFile] = File(...), priority: int = 10):
+    saved: List[str] = []
+    hashes: Dict[str, str] = {}
+    duplicates: List[Dict[str, str]] = []
+    busy: List[str] = []
+    names = [Path(f.filename or "").name for f in files]
+    if not all(names):
+        raise HTTPException(400, "Missing filename")
+    refused = [n for n in names if await run_in_threadpool(_busy, n)]
+    if refused:
+        raise HTTPException(409, f"Ingest in progress for {', '.join(refused)}; retry when the job finishes")
+    for f, name in zip(files, names):
+        tmp, sha = await _spool(f)
+        try:
+            dup = await run_in_threadpool(_place, tmp, name, sha)
+        except _Busy:
+            busy.append(name)  # a job picked it up while we were spooling
+            continue
+        if dup is not None:
+            log.info("UPLOAD SKIP (duplicate content): %s == %s", name, dup)
+            duplicates.append({"filename": name, "duplicate_of": dup})
+            continue
+        saved.append(name)
+        hashes[name] = sha
+    # auto-ingest the new files in the background; uploads outrank bulk re-ingests
+    job = None
+    if saved:
+        try:
+            job = jobs.submit("ingest_files", {"files": saved, "sha256": hashes}, priority=priority)
+        except BaseException:
+            for name, sha in hashes.items():
+                manifest.release_upload(sha, name)
+            raise
+    if busy and not saved and not duplicates:
+        raise HTTPException(409, f"Ingest in progress for {', '.join(busy)}; retry when the job finishes")
+    return JSONResponse({"uploaded": saved, "duplicates": duplicates, "busy": busy, "job": job},
+                        status_code=202 if job else 200)
@@ -0,0 +1,263 @@
+# app/services/answer_cache.py
+from __future__ import annotations
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from . import config, vectorstore
+
+log = logging.getLogger(__name__)
+
+# ---------- Semantic answer cache ----------
+# A generated answer is reused for a later query when
+#   1. the later query retrieved exactly the same chunk ids (same evidence,
+#      same model, prompt and context budget), and
+#   2. the two query embeddings have cosine similarity >= ANSWER_CACHE_SIM.
+# Entries sharing an evidence key form one small group; a lookup only scores
+# that group's vectors. Everything is persisted in
+# PROCESSED_DIR/answer_cache.sqlite3 and loaded at startup. Upserts and
+# deletes reported by vectorstore drop the entries that cited those chunks
+# from memory and from the table. Every hit is confirmed against the table,
+# so an invalidation made by another uvicorn worker takes effect here too.
+
+DB_PATH = config.PROCESSED_DIR / "answer_cache.sqlite3"
+
+def evidence_key(chunk_ids: Iterable[str], context_budget: int, variant: str = "") -> str:
+    """``variant`` names anything else that changes the context built from
+    the same chunks (e.g. compression)."""
+    h = hashlib.sha256()
+    for part in (config.ENV.OPENAI_MODEL, config.SYSTEM_PROMPT, str(context_budget), variant):
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\x1f")
+    for cid in sorted(set(chunk_ids)):
+        h.update(cid.encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+@dataclass
+class _Entry:
+    key: str
+    evidence: str
+    vec: np.ndarray
+    chunk_ids: List[str]
+    answer: str
+    created: float
+    last_used: float
+
+
+class AnswerCache:
+    def __init__(self, path, threshold: float, max_entries: int, ttl: float):
+        self.threshold = float(threshold)
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()  # least recently used first
+        self._groups: Dict[str, List[str]] = {}    # evidence -> entry keys
+        self._by_chunk: Dict[str, Set[str]] = {}   # chunk id -> entry keys
+        self._stats = {"hits": 0, "misses": 0, "puts": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, evidence TEXT NOT NULL,"
+            " vec BLOB NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS refs (chunk_id TEXT NOT NULL, key TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS refs_chunk ON refs (chunk_id)")
+        self._puts_since_trim = 0
+        self._load()
+
+    def _trim_db(self) -> None:
+        """Delete expired rows and everything beyond the max_entries most
+        recently used (rows from every worker share the table)."""
+        cutoff = time.time() - self.ttl
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM answers WHERE created < ?", (cutoff,))
+            self._db.execute(
+                "DELETE FROM answers WHERE key NOT IN"
+                " (SELECT key FROM answers ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._db.execute("DELETE FROM refs WHERE key NOT IN (SELECT key FROM answers)")
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._puts_since_trim = 0
+
+    def _load(self) -> None:
+        self._trim_db()
+        refs: Dict[str, List[str]] = {}
+        for cid, key in self._db.execute("SELECT chunk_id, key FROM refs"):
+            refs.setdefault(key, []).append(cid)
+        rows = self._db.execute(
+            "SELECT key, evidence, vec, answer, created, last_used FROM answers ORDER BY last_used"
+        ).fetchall()
+        for key, ev, vec, ans, created, used in rows:
+            self._index(_Entry(key, ev, np.frombuffer(vec, dtype=np.float32).copy(),
+                               refs.get(key, []), ans, created, used))
+        if rows:
+            log.info("Answer cache: loaded %d entries", len(rows))
+
+    # ---------- in-memory index ----------
+    def _index(self, e: _Entry) -> None:
+        self._entries[e.key] = e
+        self._groups.setdefault(e.evidence, []).append(e.key)
+        for cid in e.chunk_ids:
+            self._by_chunk.setdefault(cid, set()).add(e.key)
+
+    def _unindex(self, key: str) -> None:
+        e = self._entries.pop(key, None)
+        if e is None:
+            return
+        group = self._groups.get(e.evidence, [])
+        if key in group:
+            group.remove(key)
+        if not group:
+            self._groups.pop(e.evidence, None)
+        for cid in e.chunk_ids:
+            keys = self._by_chunk.get(cid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_chunk[cid]
+
+    def _delete(self, keys: List[str]) -> None:
+        for k in keys:
+            self._unindex(k)
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            marks = ",".join("?" * len(part))
+            self._db.execute(f"DELETE FROM answers WHERE key IN ({marks})", part)
+            self._db.execute(f"DELETE FROM refs WHERE key IN ({marks})", part)
+
+    # ---------- public ----------
+    def get(self, q_vec: np.ndarray, evidence: str) -> Optional[str]:
+        q = np.asarray(q_vec, dtype=np.float32)
+        with self._lock:
+            now = time.time()
+            keys = self._groups.get(evidence)
+            if keys:
+                expired = [k for k in keys if now - self._entries[k].created > self.ttl]
+                if expired:
+                    self._delete(expired)
+                    self._stats["expired"] += len(expired)
+                    keys = self._groups.get(evidence)
+            if not keys:
+                self._stats["misses"] += 1
+                return None
+            mat = np.stack([self._entries[k].vec for k in keys])
+            sims = mat @ q
+            best = int(np.argmax(sims))
+            if float(sims[best]) < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            e = self._entries[keys[best]]
+            # the row is gone if another worker invalidated or evicted it
+            if not self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, e.key)).rowcount:
+                self._unindex(e.key)
+                self._stats["invalidated"] += 1
+                self._stats["misses"] += 1
+                return None
+            e.last_used = now
+            self._entries.move_to_end(e.key)
+            self._stats["hits"] += 1
+            return e.answer
+
+    def put(self, q_vec: np.ndarray, evidence: str, chunk_ids: List[str], answer: str) -> None:
+        vec = np.asarray(q_vec, dtype=np.float32)
+        ids = sorted(set(chunk_ids))
+        now = time.time()
+        key = hashlib.sha256(evidence.encode("utf-8") + vec.tobytes()).hexdigest()
+        with self._lock:
+            if key in self._entries:
+                self._delete([key])
+            if len(self._entries) >= self.max_entries:
+                n = len(self._entries) - self.max_entries + 1
+                self._delete([k for k, _ in zip(self._entries, range(n))])
+                self._stats["evictions"] += n
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                                 (key, evidence, vec.tobytes(), answer, now, now))
+                self._db.executemany("INSERT INTO refs VALUES (?, ?)", [(cid, key) for cid in ids])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._index(_Entry(key, evidence, vec, ids, answer, now, now))
+            self._stats["puts"] += 1
+            self._puts_since_trim += 1
+            if self._puts_since_trim >= max(100, self.max_entries // 10):
+                self._trim_db()
+
+    def invalidate(self, chunk_ids: Optional[List[str]]) -> int:
+        """Drop answers built from any of ``chunk_ids`` (all answers if None),
+        including entries written by other workers."""
+        with self._lock:
+            if chunk_ids is None:
+                n = len(self._entries)
+                self._entries.clear(); self._groups.clear(); self._by_chunk.clear()
+                self._db.execute("DELETE FROM answers")
+                self._db.execute("DELETE FROM refs")
+                self._stats["invalidated"] += n
+                return n
+            keys: Set[str] = set()
+            ids = list(set(chunk_ids))
+            for cid in ids:
+                keys |= self._by_chunk.get(cid, set())
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                q = "SELECT key FROM refs WHERE chunk_id IN (%s)" % ",".join("?" * len(part))
+                keys.update(k for (k,) in self._db.execute(q, part))
+            if keys:
+                self._delete(list(keys))
+                self._stats["invalidated"] += len(keys)
+            return len(keys)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "threshold": self.threshold}
+
+
+_cache: Optional[AnswerCache] = None
+_cache_lock = threading.Lock()
+_unavailable = False
+
+def get_cache() -> Optional[AnswerCache]:
+    global _cache, _unavailable
+    if not config.ENV.ANSWER_CACHE or _unavailable:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = AnswerCache(
+                    DB_PATH,
+                    threshold=config.ENV.ANSWER_CACHE_SIM,
+                    max_entries=config.ENV.ANSWER_CACHE_MAX,
+                    ttl=config.ENV.ANSWER_CACHE_TTL_S,
+                )
+            except Exception as e:
+                log.warning("Answer cache unavailable (%s); answering without it", e)
+                _unavailable = True
+        return _cache
+
+def stats() -> Dict:
+    return _cache.stats() if _cache is not None else {"entries": 0}
+
+def _on_corpus_change(chunk_ids: Optional[List[str]]) -> None:
+    cache = get_cache()
+    if cache is not None:
+        n = cache.invalidate(chunk_ids)
+        if n:
+            log.info("Answer cache: invalidated %d entries", n)
+
+vectorstore.add_change_listener(_on_corpus_change)
@@ -0,0 +1,833 @@
+# app/services/bm25.py
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def tokenize(s: str) -> List[str]:
+    if not s:
+        return []
+    return [t for t in s.lower().split() if t.strip()]
+
+
+def _grow(arr: np.ndarray, need: int) -> np.ndarray:
+    if need <= len(arr):
+        return arr
+    out = np.zeros(max(need, 2 * len(arr), 16), dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+
+def _ptr(lengths: np.ndarray) -> np.ndarray:
+    out = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=out[1:])
+    return out
+
+
+def _blob(items: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    data = np.frombuffer(b"".join(items), dtype=np.uint8)
+    return data, _ptr(np.array([len(x) for x in items], dtype=np.int64))
+
+
+def _unblob(data: np.ndarray, ptr: np.ndarray) -> List[bytes]:
+    raw = data.tobytes()
+    p = ptr.tolist()
+    return [raw[p[i]:p[i + 1]] for i in range(len(p) - 1)]
+
+
+# ---------- On-disk snapshot format ----------
+# header: magic, format version, section count, generation
+# section table: name, numpy dtype str, byte offset, element count
+# sections are raw little-endian arrays aligned to 64 bytes
+FORMAT_MAGIC = b"LEOBM25\x00"
+FORMAT_VERSION = 3
+_HEADER = struct.Struct("<8sIIQ")
+_SECTION = struct.Struct("<16s8sQQ")
+_ALIGN = 64
+
+_SECTIONS = (
+    "terms", "term_ptr",               # vocabulary, utf-8, sorted by bytes
+    "post_ptr", "post_docs", "post_tfs",
+    "ids", "id_ptr", "doc_len",
+    "id_order",                        # doc slots sorted by id bytes
+    "fwd_ptr", "fwd_tids",             # forward index: term ids per doc
+    "doc_src", "doc_page", "doc_lang", # per-doc filter columns
+    "srcs", "src_ptr", "langs", "lang_ptr",  # source / language vocabularies
+)
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_snapshot(path: Path, arrays: Dict[str, np.ndarray], generation: int) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    table = []
+    offset = _align(_HEADER.size + _SECTION.size * len(arrays))
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        table.append((name, arr, offset))
+        offset = _align(offset + arr.nbytes)
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, len(table), generation))
+        for name, arr, off in table:
+            f.write(_SECTION.pack(name.encode("ascii"), arr.dtype.str.encode("ascii"), off, arr.size))
+        for name, arr, off in table:
+            f.seek(off)
+            f.write(arr.data)
+        f.truncate(offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: Path) -> Tuple[int, Dict[str, np.ndarray]]:
+    """Map a snapshot read-only. The returned arrays are views into the
+    shared page cache and keep the mapping alive."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, n_sections, generation = _HEADER.unpack_from(mm, 0)
+    if magic != FORMAT_MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"unsupported BM25 snapshot {path} (version {version})")
+    arrays: Dict[str, np.ndarray] = {}
+    for i in range(n_sections):
+        name, dtype, off, count = _SECTION.unpack_from(mm, _HEADER.size + i * _SECTION.size)
+        arrays[name.rstrip(b"\x00").decode("ascii")] = np.frombuffer(
+            mm, dtype=np.dtype(dtype.rstrip(b"\x00").decode("ascii")), count=count, offset=off
+        )
+    missing = [s for s in _SECTIONS if s not in arrays]
+    if missing:
+        raise ValueError(f"BM25 snapshot {path} is missing sections {missing}")
+    return generation, arrays
+
+
+class _FileLock:
+    """Cross-process lock via an O_EXCL lock file (Windows and POSIX)."""
+
+    def __init__(self, path: Path, timeout: float = 60.0, stale: float = 300.0):
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                self._fd = os.open(str(self.path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(self._fd, str(os.getpid()).encode("ascii"))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - self.path.stat().st_mtime > self.stale:
+                        log.warning("Breaking stale lock %s", self.path)
+                        self.path.unlink()
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"could not acquire {self.path}")
+                time.sleep(0.01)
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# ---------- In-memory structures ----------
+class _Segment:
+    """Immutable, compacted index state (usually memory-mapped)."""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.a = arrays
+        self.n_terms = len(arrays["term_ptr"]) - 1
+        self.n_docs = len(arrays["id_ptr"]) - 1
+
+    @classmethod
+    def empty(cls) -> "_Segment":
+        z64 = np.zeros(1, dtype=np.int64)
+        return cls({
+            "terms": np.zeros(0, dtype=np.uint8), "term_ptr": z64,
+            "post_ptr": z64, "post_docs": np.zeros(0, dtype=np.int32),
+            "post_tfs": np.zeros(0, dtype=np.uint16),
+            "ids": np.zeros(0, dtype=np.uint8), "id_ptr": z64,
+            "doc_len": np.zeros(0, dtype=np.float32), "id_order": np.zeros(0, dtype=np.int32),
+            "fwd_ptr": z64, "fwd_tids": np.zeros(0, dtype=np.int32),
+            "doc_src": np.zeros(0, dtype=np.int32), "doc_page": np.zeros(0, dtype=np.int32),
+            "doc_lang": np.zeros(0, dtype=np.int32),
+            "srcs": np.zeros(0, dtype=np.uint8), "src_ptr": z64,
+            "langs": np.zeros(0, dtype=np.uint8), "lang_ptr": z64,
+        })
+
+    def term(self, tid: int) -> bytes:
+        p = self.a["term_ptr"]
+        return self.a["terms"][int(p[tid]):int(p[tid + 1])].tobytes()
+
+    def find(self, term: bytes) -> int:
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.n_terms and self.term(lo) == term else -1
+
+    def postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        p = self.a["post_ptr"]
+        s, e = int(p[tid]), int(p[tid + 1])
+        return self.a["post_docs"][s:e], self.a["post_tfs"][s:e]
+
+    def _id_bytes(self, slot: int) -> bytes:
+        p = self.a["id_ptr"]
+        return self.a["ids"][int(p[slot]):int(p[slot + 1])].tobytes()
+
+    def doc_id(self, slot: int) -> str:
+        return self._id_bytes(slot).decode("utf-8")
+
+    def find_doc(self, doc_id: bytes) -> int:
+        order = self.a["id_order"]
+        lo, hi = 0, self.n_docs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_bytes(int(order[mid])) < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_docs and self._id_bytes(int(order[lo])) == doc_id:
+            return int(order[lo])
+        return -1
+
+    def doc_terms(self, slot: int) -> np.ndarray:
+        p = self.a["fwd_ptr"]
+        return self.a["fwd_tids"][int(p[slot]):int(p[slot + 1])]
+
+
+class _Postings:
+    """Posting list for one term: doc slots (int32) and term freqs (uint16),
+    append-only with amortized doubling. Entries of removed docs stay until
+    the list is compacted."""
+    __slots__ = ("docs", "tfs", "n")
+
+    def __init__(self, docs: Optional[np.ndarray] = None, tfs: Optional[np.ndarray] = None):
+        if docs is None:
+            self.docs = np.zeros(4, dtype=np.int32)
+            self.tfs = np.zeros(4, dtype=np.uint16)
+            self.n = 0
+        else:
+            self.docs = np.array(docs, dtype=np.int32)
+            self.tfs = np.array(tfs, dtype=np.uint16)
+            self.n = len(self.docs)
+
+    def append(self, slot: int, tf: int) -> None:
+        if self.n == len(self.docs):
+            self.docs = _grow(self.docs, self.n + 1)
+            self.tfs = _grow(self.tfs, self.n + 1)
+        self.docs[self.n] = slot
+        self.tfs[self.n] = min(tf, 65535)
+        self.n += 1
+
+
+class BM25Index:
+    """
+    Incremental Okapi BM25 index over an inverted index.
+
+    Postings are compact NumPy arrays; a query only scores documents that
+    contain at least one query term and selects the top-k with a partial sort.
+    Documents are added/removed by id: removals tombstone the doc slot and
+    update document frequencies in place, and posting lists are compacted
+    lazily once enough of their entries are dead. Each doc also carries
+    source/page/language columns; ``where`` filters become a per-filter doc
+    bitset that is applied to posting lists before scores are merged.
+
+    With ``path`` set the index is persistent: a versioned snapshot
+    (``index.<gen>.bin``, opened with mmap so workers share its pages) plus an
+    append-only journal of add/remove ops (``journal.<gen>.jsonl``), with
+    ``CURRENT`` naming the live generation. Writers append under a file lock
+    and every worker replays the journal in order, so an ingest in one worker
+    shows up in the others on their next :meth:`sync`. The journal is folded
+    into a new snapshot once it grows.
+    """
+
+    # Renumber doc slots once this fraction (and at least this many) is dead.
+    COMPACT_RATIO = 0.25
+    COMPACT_MIN_DEAD = 1024
+    # Fold the journal into a new snapshot past this size (bytes), or past
+    # half the snapshot size, whichever is larger.
+    JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+    # Minimum seconds between journal polls in sync().
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path: Path | str | None = None, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.path = Path(path) if path else None
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._journal_pos = 0
+        self._last_sync = 0.0
+        self._set_base(_Segment.empty())
+
+    # ---------- State ----------
+    def _set_base(self, seg: _Segment) -> None:
+        self._base = seg
+        # vocabulary overlay: new terms get ids >= seg.n_terms
+        self._new_terms: Dict[str, int] = {}
+        self._new_term_bytes: List[bytes] = []
+        # copy-on-write posting lists, keyed by term id
+        self._postings: Dict[int, _Postings] = {}
+        self._df = np.diff(seg.a["post_ptr"]).astype(np.int32)
+        self._dead = np.zeros(seg.n_terms, dtype=np.int32)
+        # doc table: slots < seg.n_docs live in the segment
+        self._new_ids: List[Optional[str]] = []
+        self._new_fwd: List[np.ndarray] = []
+        self._doc_len = seg.a["doc_len"]
+        self._alive = np.ones(seg.n_docs, dtype=bool)
+        self._n_alive = seg.n_docs
+        self._total_len = float(self._doc_len.sum(dtype=np.float64))
+        # live overlay docs (slots >= seg.n_docs); base docs are found by
+        # binary search over the snapshot's id_order
+        self._new_slot_of: Dict[str, int] = {}
+        self._slot_of: Optional[Dict[str, int]] = None
+        # filter columns; sources/languages are ids into small vocabularies
+        self._doc_src = seg.a["doc_src"]
+        self._doc_page = seg.a["doc_page"]
+        self._doc_lang = seg.a["doc_lang"]
+        self._src_names = [b.decode("utf-8") for b in _unblob(seg.a["srcs"], seg.a["src_ptr"])]
+        self._src_idx = {s: i for i, s in enumerate(self._src_names)}
+        self._lang_names = [b.decode("utf-8") for b in _unblob(seg.a["langs"], seg.a["lang_ptr"])]
+        self._lang_idx = {s: i for i, s in enumerate(self._lang_names)}
+        self._masks: Dict[Tuple, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return self._n_alive
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self._lock:
+            return self._slot(doc_id) >= 0
+
+    def _n_slots(self) -> int:
+        return self._base.n_docs + len(self._new_ids)
+
+    def _id_at(self, slot: int) -> str:
+        nb = self._base.n_docs
+        return self._base.doc_id(slot) if slot < nb else self._new_ids[slot - nb]
+
+    def _terms_of(self, slot: int) -> np.ndarray:
+        nb = self._base.n_docs
+        return self._base.doc_terms(slot) if slot < nb else self._new_fwd[slot - nb]
+
+    def _slot(self, doc_id: str) -> int:
+        """Live slot of ``doc_id`` or -1."""
+        if self._slot_of is not None:
+            return self._slot_of.get(doc_id, -1)
+        slot = self._new_slot_of.get(doc_id)
+        if slot is not None:
+            return slot
+        slot = self._base.find_doc(doc_id.encode("utf-8"))
+        return slot if slot >= 0 and self._alive[slot] else -1
+
+    def _slots(self) -> Dict[str, int]:
+        # full id -> slot map for the writer (journal appends, in-memory
+        # indexes); workers that only replay the journal use _slot()
+        if self._slot_of is None:
+            ids = [b.decode("utf-8") for b in _unblob(self._base.a["ids"], self._base.a["id_ptr"])]
+            ids.extend(self._new_ids)
+            self._slot_of = {
+                ids[s]: s for s in np.nonzero(self._alive[:self._n_slots()])[0].tolist()
+            }
+        return self._slot_of
+
+    def _lookup(self, term: str) -> int:
+        tid = self._base.find(term.encode("utf-8"))
+        if tid < 0:
+            tid = self._new_terms.get(term, -1)
+        return tid
+
+    def _term_id(self, term: str) -> int:
+        tid = self._lookup(term)
+        if tid < 0:
+            tid = self._base.n_terms + len(self._new_term_bytes)
+            self._new_terms[term] = tid
+            self._new_term_bytes.append(term.encode("utf-8"))
+            self._df = _grow(self._df, tid + 1)
+            self._dead = _grow(self._dead, tid + 1)
+        return tid
+
+    def _plist(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        p = self._postings.get(tid)
+        if p is not None:
+            return p.docs[:p.n], p.tfs[:p.n]
+        if tid < self._base.n_terms:
+            return self._base.postings(tid)
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16)
+
+    def _mutable_plist(self, tid: int) -> _Postings:
+        p = self._postings.get(tid)
+        if p is None:
+            if tid < self._base.n_terms:
+                p = _Postings(*self._base.postings(tid))
+            else:
+                p = _Postings()
+            self._postings[tid] = p
+        return p
+
+    # ---------- Mutation ----------
+    def clear(self) -> None:
+        with self._lock:
+            if not self.path:
+                self._set_base(_Segment.empty())
+                return
+            self.path.mkdir(parents=True, exist_ok=True)
+            with _FileLock(self.path / "LOCK"):
+                self._commit(_Segment.empty().a)
+
+    def add(self, ids: Iterable[str], texts: Iterable[str], metas: Optional[Iterable[Dict]] = None) -> None:
+        """Add documents; an id that is already indexed is replaced. ``metas``
+        supplies each doc's filterable ``source``/``page``/``language``."""
+        docs = []
+        ids, texts = list(ids), list(texts)
+        metas = list(metas) if metas is not None else [{}] * len(ids)
+        for doc_id, text, meta in zip(ids, texts, metas):
+            tokens = tokenize(text)
+            meta = meta or {}
+            docs.append((doc_id, len(tokens), dict(Counter(tokens)), [
+                str(meta.get("source") or ""), int(meta.get("page") or 0), str(meta.get("language") or ""),
+            ]))
+        if docs:
+            self._apply_logged({"op": "add", "docs": docs})
+
+    def remove(self, ids: Iterable[str]) -> int:
+        ids = list(ids)
+        if not ids:
+            return 0
+        return self._apply_logged({"op": "remove", "ids": ids})
+
+    def _apply_logged(self, op: Dict) -> int:
+        with self._lock:
+            self._slots()
+            if not self.path:
+                n = self._apply(op)
+                self._maybe_compact()
+                return n
+            self.path.mkdir(parents=True, exist_ok=True)
+            with _FileLock(self.path / "LOCK"):
+                # catch up first so every worker applies ops in journal order
+                self._sync_locked()
+                self._slots()  # a generation switch dropped the map
+                line = json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n"
+                with open(self._journal_path(self._generation), "ab") as f:
+                    f.write(line.encode("utf-8"))
+                    self._journal_pos = f.tell()
+                n = self._apply(op)
+                if self._needs_snapshot():
+                    self._commit(self._export())
+                return n
+
+    def _apply(self, op: Dict) -> int:
+        n = 0
+        if op.get("op") == "add":
+            self._masks.clear()
+            for doc_id, length, tf, meta in op["docs"]:
+                slot = self._slot(doc_id)
+                if slot >= 0:
+                    self._remove_one(doc_id, slot)
+                self._add_one(doc_id, length, tf, meta)
+                n += 1
+        elif op.get("op") == "remove":
+            for doc_id in op["ids"]:
+                slot = self._slot(doc_id)
+                if slot >= 0:
+                    self._remove_one(doc_id, slot)
+                    n += 1
+        return n
+
+    def _vocab_id(self, names: List[str], idx: Dict[str, int], value: str) -> int:
+        i = idx.get(value)
+        if i is None:
+            i = idx[value] = len(names)
+            names.append(value)
+        return i
+
+    def _add_one(self, doc_id: str, length: int, tf: Dict[str, int], meta: List) -> None:
+        slot = self._n_slots()
+        self._new_ids.append(doc_id)
+        self._new_slot_of[doc_id] = slot
+        if self._slot_of is not None:
+            self._slot_of[doc_id] = slot
+        self._doc_len = _grow(self._doc_len, slot + 1)
+        self._alive = _grow(self._alive, slot + 1)
+        self._doc_src = _grow(self._doc_src, slot + 1)
+        self._doc_page = _grow(self._doc_page, slot + 1)
+        self._doc_lang = _grow(self._doc_lang, slot + 1)
+        self._doc_len[slot] = length
+        self._alive[slot] = True
+        source, page, lang = meta
+        self._doc_src[slot] = self._vocab_id(self._src_names, self._src_idx, source)
+        self._doc_page[slot] = page
+        self._doc_lang[slot] = self._vocab_id(self._lang_names, self._lang_idx, lang)
+        self._n_alive += 1
+        self._total_len += length
+
+        tids = np.empty(len(tf), dtype=np.int32)
+        for j, (term, n) in enumerate(tf.items()):
+            tid = self._term_id(term)
+            self._mutable_plist(tid).append(slot, n)
+            tids[j] = tid
+        self._df[tids] += 1
+        self._new_fwd.append(tids)
+
+    def _remove_one(self, doc_id: str, slot: int) -> None:
+        self._new_slot_of.pop(doc_id, None)
+        if self._slot_of is not None:
+            self._slot_of.pop(doc_id, None)
+        self._alive[slot] = False
+        self._n_alive -= 1
+        self._total_len -= float(self._doc_len[slot])
+        tids = self._terms_of(slot)
+        self._df[tids] -= 1
+        self._dead[tids] += 1
+        for tid in tids.tolist():
+            docs, tfs = self._plist(tid)
+            if self._dead[tid] * 2 > len(docs):
+                keep = self._alive[docs]
+                self._postings[tid] = _Postings(docs[keep], tfs[keep])
+                self._dead[tid] = 0
+        if slot >= self._base.n_docs:
+            self._new_ids[slot - self._base.n_docs] = None
+            self._new_fwd[slot - self._base.n_docs] = np.zeros(0, dtype=np.int32)
+
+    def _too_many_dead(self) -> bool:
+        n_dead = self._n_slots() - self._n_alive
+        return n_dead >= self.COMPACT_MIN_DEAD and n_dead >= self.COMPACT_RATIO * self._n_slots()
+
+    def _maybe_compact(self) -> None:
+        if self._too_many_dead():
+            self._set_base(_Segment(self._export()))
+
+    # ---------- Snapshot / journal ----------
+    def _export(self) -> Dict[str, np.ndarray]:
+        """Compacted arrays of the current state: dead docs and unused terms
+        dropped, doc slots renumbered, vocabulary sorted."""
+        base = self._base
+        n_slots = self._n_slots()
+        alive = self._alive[:n_slots]
+
+        # flat (term id, doc slot, tf) triples: segment lists not overridden
+        # by a copy-on-write list, then the overlay lists
+        tids_p, docs_p, tfs_p = [], [], []
+        if base.n_terms:
+            btids = np.repeat(np.arange(base.n_terms, dtype=np.int32), np.diff(base.a["post_ptr"]))
+            over = np.zeros(base.n_terms, dtype=bool)
+            over[[t for t in self._postings if t < base.n_terms]] = True
+            keep = ~over[btids]
+            tids_p.append(btids[keep])
+            docs_p.append(base.a["post_docs"][keep])
+            tfs_p.append(base.a["post_tfs"][keep])
+        for tid, p in self._postings.items():
+            tids_p.append(np.full(p.n, tid, dtype=np.int32))
+            docs_p.append(p.docs[:p.n])
+            tfs_p.append(p.tfs[:p.n])
+        tids = np.concatenate(tids_p) if tids_p else np.zeros(0, dtype=np.int32)
+        docs = np.concatenate(docs_p) if docs_p else np.zeros(0, dtype=np.int32)
+        tfs = np.concatenate(tfs_p) if tfs_p else np.zeros(0, dtype=np.uint16)
+        keep = alive[docs]
+        tids, docs, tfs = tids[keep], docs[keep], tfs[keep]
+
+        n_alive = int(alive.sum())
+        remap = np.full(n_slots, -1, dtype=np.int32)
+        remap[alive] = np.arange(n_alive, dtype=np.int32)
+        docs = remap[docs]
+
+        all_terms = _unblob(base.a["terms"], base.a["term_ptr"]) + self._new_term_bytes
+        df = np.bincount(tids, minlength=len(all_terms))
+        order = sorted(np.nonzero(df)[0].tolist(), key=all_terms.__getitem__)
+        new_tid = np.full(len(all_terms), -1, dtype=np.int32)
+        new_tid[order] = np.arange(len(order), dtype=np.int32)
+        tids = new_tid[tids]
+
+        o = np.lexsort((docs, tids))
+        post_docs, post_tfs = docs[o].astype(np.int32), tfs[o].astype(np.uint16)
+        post_ptr = _ptr(np.bincount(tids, minlength=len(order)))
+        o = np.lexsort((tids, docs))
+        fwd_tids = tids[o].astype(np.int32)
+        fwd_ptr = _ptr(np.bincount(docs, minlength=n_alive))
+
+        base_ids = _unblob(base.a["ids"], base.a["id_ptr"])
+        new_ids = [(i or "").encode("utf-8") for i in self._new_ids]
+        all_ids = base_ids + new_ids
+        terms, term_ptr = _blob([all_terms[t] for t in order])
+        live_ids = [all_ids[s] for s in np.nonzero(alive)[0].tolist()]
+        ids, id_ptr = _blob(live_ids)
+        id_order = np.array(sorted(range(len(live_ids)), key=live_ids.__getitem__), dtype=np.int32)
+        # drop sources/languages no live doc refers to
+        used_src, doc_src = np.unique(self._doc_src[:n_slots][alive], return_inverse=True)
+        used_lang, doc_lang = np.unique(self._doc_lang[:n_slots][alive], return_inverse=True)
+        srcs, src_ptr = _blob([self._src_names[i].encode("utf-8") for i in used_src.tolist()])
+        langs, lang_ptr = _blob([self._lang_names[i].encode("utf-8") for i in used_lang.tolist()])
+        return {
+            "terms": terms, "term_ptr": term_ptr,
+            "post_ptr": post_ptr, "post_docs": post_docs, "post_tfs": post_tfs,
+            "ids": ids, "id_ptr": id_ptr,
+            "doc_len": self._doc_len[:n_slots][alive].astype(np.float32), "id_order": id_order,
+            "fwd_ptr": fwd_ptr, "fwd_tids": fwd_tids,
+            "doc_src": doc_src.astype(np.int32), "doc_page": self._doc_page[:n_slots][alive].astype(np.int32),
+            "doc_lang": doc_lang.astype(np.int32),
+            "srcs": srcs, "src_ptr": src_ptr, "langs": langs, "lang_ptr": lang_ptr,
+        }
+
+    def _snapshot_path(self, gen: int) -> Path:
+        return self.path / f"index.{gen}.bin"
+
+    def _journal_path(self, gen: int) -> Path:
+        return self.path / f"journal.{gen}.jsonl"
+
+    def _current_generation(self) -> int:
+        try:
+            return int((self.path / "CURRENT").read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _needs_snapshot(self) -> bool:
+        try:
+            size = self._journal_path(self._generation).stat().st_size
+            base = self._snapshot_path(self._generation).stat().st_size
+        except FileNotFoundError:
+            return False
+        return size > max(self.JOURNAL_MAX_BYTES, base // 2) or self._too_many_dead()
+
+    def _commit(self, arrays: Dict[str, np.ndarray]) -> None:
+        """Write ``arrays`` as the next generation and switch to it. Caller
+        holds the file lock."""
+        gen = max(self._generation, self._current_generation()) + 1
+        write_snapshot(self._snapshot_path(gen), arrays, gen)
+        self._journal_path(gen).touch()
+        tmp = self.path / "CURRENT.tmp"
+        tmp.write_text(str(gen))
+        os.replace(tmp, self.path / "CURRENT")
+        self._load(gen)
+        for old in list(self.path.glob("index.*.bin")) + list(self.path.glob("journal.*.jsonl")):
+            try:
+                if int(old.name.split(".")[1]) < gen:
+                    old.unlink()
+            except (ValueError, OSError):
+                pass  # still mapped by another worker (Windows); retried next commit
+
+    def _load(self, gen: int) -> None:
+        g, arrays = read_snapshot(self._snapshot_path(gen))
+        self._set_base(_Segment(arrays))
+        self._generation = g
+        self._journal_pos = 0
+        self._replay()
+
+    def _replay(self) -> int:
+        try:
+            with open(self._journal_path(self._generation), "rb") as f:
+                f.seek(self._journal_pos)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        end = data.rfind(b"\n") + 1  # a partially written last line waits
+        applied = 0
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply(json.loads(line))
+                applied += 1
+        self._journal_pos += end
+        return applied
+
+    def _sync_locked(self) -> int:
+        gen = self._current_generation()
+        if gen and gen != self._generation:
+            self._load(gen)
+            return 1
+        return self._replay()
+
+    def open(self) -> bool:
+        """Load the persisted index. Returns False if there is none or it is
+        unreadable / from another format version (caller should rebuild)."""
+        if not self.path:
+            return False
+        with self._lock:
+            gen = self._current_generation()
+            if not gen:
+                return False
+            try:
+                self._load(gen)
+            except (OSError, ValueError) as e:
+                log.warning("BM25 snapshot unusable (%s); needs rebuild", e)
+                return False
+            self._last_sync = time.monotonic()
+            return True
+
+    def sync(self) -> int:
+        """Pick up changes written by other workers. Returns the number of
+        journal ops applied (1 for a generation switch)."""
+        if not self.path:
+            return 0
+        now = time.monotonic()
+        if now - self._last_sync < self.SYNC_INTERVAL:
+            return 0
+        with self._lock:
+            self._last_sync = now
+            try:
+                return self._sync_locked()
+            except (OSError, ValueError) as e:
+                log.warning("BM25 sync failed: %s", e)
+                return 0
+
+    def rebuild(self, batches: Iterable[Tuple[List[str], List[str], List[Dict]]]) -> None:
+        """Replace the whole index with ``batches`` of (ids, texts, metas).
+        Queries keep using the old state until the new one is committed."""
+        fresh = BM25Index(k1=self.k1, b=self.b)
+        for ids, texts, metas in batches:
+            fresh.add(ids, texts, metas)
+        arrays = fresh._export()
+        with self._lock:
+            if not self.path:
+                self._set_base(_Segment(arrays))
+                return
+            self.path.mkdir(parents=True, exist_ok=True)
+            with _FileLock(self.path / "LOCK"):
+                self._commit(arrays)
+
+    # ---------- Scoring ----------
+    def _idf(self, df: np.ndarray | int, n_docs: int):
+        # Non-negative BM25 idf (Lucene variant); rank_bm25's epsilon floor
+        # needs the average idf over the whole vocabulary, which is not
+        # maintainable incrementally.
+        return np.log1p((n_docs - df + 0.5) / (df + 0.5))
+
+    def _term_scores(self, term: str, n_docs: int, avgdl: float,
+                     mask: Optional[np.ndarray] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        tid = self._lookup(term)
+        if tid < 0 or self._df[tid] <= 0:
+            return None
+        k1, b = self.k1, self.b
+        docs, tfs = self._plist(tid)
+        if mask is not None:
+            sel = mask[docs]
+            if not sel.any():
+                return None
+            docs, tfs = docs[sel], tfs[sel]
+        tfs = tfs.astype(np.float32)
+        idf = float(self._idf(int(self._df[tid]), n_docs))
+        norm = k1 * (1.0 - b + b * self._doc_len[docs] / avgdl)
+        return docs, idf * tfs * (k1 + 1.0) / (tfs + norm)
+
+    def _where_mask(self, where: Optional[Dict]) -> Optional[np.ndarray]:
+        """Doc-slot bitset for a ``{"source"|"page"|"language": value or
+        list}`` filter, cached until the next add."""
+        if not where:
+            return None
+        key = tuple(sorted(
+            (f, tuple(v) if isinstance(v, (list, tuple, set)) else (v,))
+            for f, v in where.items() if v is not None
+        ))
+        if not key:
+            return None
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+        n = self._n_slots()
+        mask = np.ones(n, dtype=bool)
+        for field, values in key:
+            if field == "page":
+                mask &= np.isin(self._doc_page[:n], np.array([int(v) for v in values], dtype=np.int32))
+                continue
+            if field == "source":
+                col, idx = self._doc_src, self._src_idx
+            elif field == "language":
+                col, idx = self._doc_lang, self._lang_idx
+            else:
+                raise ValueError(f"unsupported BM25 filter field {field!r}")
+            wanted = [idx[str(v)] for v in values if str(v) in idx]
+            if not wanted:
+                mask[:] = False
+                break
+            mask &= np.isin(col[:n], np.array(wanted, dtype=np.int32))
+        if len(self._masks) >= 64:
+            self._masks.clear()
+        self._masks[key] = mask
+        return mask
+
+    def _select(self, part_docs: List[np.ndarray], part_w: List[np.ndarray], n: int) -> List[Tuple[str, float]]:
+        if not part_docs:
+            return []
+        if len(part_docs) == 1:
+            docs, scores = part_docs[0], part_w[0]
+        else:
+            docs, inv = np.unique(np.concatenate(part_docs), return_inverse=True)
+            scores = np.bincount(inv, weights=np.concatenate(part_w))
+        keep = self._alive[docs]
+        docs, scores = docs[keep], scores[keep]
+        if len(docs) > n:
+            part = np.argpartition(-scores, n - 1)[:n]
+            docs, scores = docs[part], scores[part]
+        order = np.argsort(-scores, kind="stable")
+        return [(self._id_at(int(docs[i])), float(scores[i])) for i in order]
+
+    def idf(self, terms: Iterable[str]) -> Dict[str, float]:
+        """Corpus idf per term; terms the index has never seen score as if
+        they occurred in one document."""
+        with self._lock:
+            n_docs = max(1, self._n_alive)
+            out: Dict[str, float] = {}
+            for term in terms:
+                tid = self._lookup(term)
+                df = int(self._df[tid]) if tid >= 0 else 0
+                out[term] = float(self._idf(max(1, df), n_docs))
+            return out
+
+    def top_n(self, query_tokens: List[str], n: int, where: Optional[Dict] = None) -> List[Tuple[str, float]]:
+        """Return up to ``n`` (id, score) pairs, best first. Cost depends on
+        the posting lengths of the query terms, not on corpus size."""
+        return self.top_n_many([query_tokens], n, where=where)[0]
+
+    def top_n_many(self, queries: List[List[str]], n: int, where: Optional[Dict] = None) -> List[List[Tuple[str, float]]]:
+        """:meth:`top_n` for several token lists in one pass; each distinct
+        term's posting list is scored once and shared across queries. With
+        ``where``, only matching docs are scored (idf stays corpus-wide)."""
+        if n <= 0:
+            return [[] for _ in queries]
+        with self._lock:
+            n_docs = self._n_alive
+            if not n_docs:
+                return [[] for _ in queries]
+            mask = self._where_mask(where)
+            if mask is not None and not mask.any():
+                return [[] for _ in queries]
+            avgdl = (self._total_len / n_docs) or 1.0
+            scored: Dict[str, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+            out: List[List[Tuple[str, float]]] = []
+            for tokens in queries:
+                part_docs: List[np.ndarray] = []
+                part_w: List[np.ndarray] = []
+                for term, qtf in Counter(tokens).items():
+                    if term not in scored:
+                        scored[term] = self._term_scores(term, n_docs, avgdl, mask)
+                    ts = scored[term]
+                    if ts is None:
+                        continue
+                    part_docs.append(ts[0])
+                    part_w.append(ts[1] * qtf if qtf != 1 else ts[1])
+                out.append(self._select(part_docs, part_w, n))
+            return out
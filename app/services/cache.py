@@ -0,0 +1,197 @@
+# app/services/cache.py
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from typing import Any, Dict, Hashable, Optional
+import sys
+import threading
+
+import numpy as np
+
+# ---------- Size accounting ----------
+def sizeof(value: Any) -> int:
+    """Approximate memory held by ``value``: arrays by nbytes, strings by
+    length, containers and dataclasses recursively."""
+    if value is None:
+        return 16
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes) + 112
+    if isinstance(value, (str, bytes)):
+        return len(value) + 49
+    if isinstance(value, (int, float, bool)):
+        return 28
+    if isinstance(value, dict):
+        return 64 + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 56 + 8 * len(value) + sum(sizeof(v) for v in value)
+    if is_dataclass(value):
+        return 56 + sum(sizeof(getattr(value, f.name)) for f in fields(value))
+    return sys.getsizeof(value)
+
+# ---------- LRU ----------
+class LRUCache:
+    """
+    Thread-safe LRU bounded by approximate bytes. Every entry records the
+    version it was computed against; a lookup with a different version is
+    a miss and drops the entry, so bumping a version counter invalidates
+    everything derived from the old state without a sweep.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max(0, int(max_bytes))
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (version, value, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "puts": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+            if item[0] != version:
+                self._drop(key)
+                self._stats["stale"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any, version: Any = None, nbytes: Optional[int] = None) -> None:
+        if not self.enabled:
+            return
+        n = (nbytes if nbytes is not None else sizeof(value)) + sizeof(key)
+        if n > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (version, value, n)
+            self._bytes += n
+            self._stats["puts"] += 1
+            while self._bytes > self.max_bytes:
+                old, _ = next(iter(self._data.items()))
+                self._drop(old)
+                self._stats["evictions"] += 1
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, n = self._data.pop(key)
+        self._bytes -= n
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            st = dict(self._stats)
+            lookups = st["hits"] + st["misses"]
+            st.update({
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(st["hits"] / lookups, 4) if lookups else 0.0,
+            })
+            return st
+
+_registry: Dict[str, LRUCache] = {}
+_registry_lock = threading.Lock()
+
+def get_cache(name: str, max_mb: float) -> LRUCache:
+    """Process-wide named cache, created on first use."""
+    with _registry_lock:
+        c = _registry.get(name)
+        if c is None:
+            c = _registry[name] = LRUCache(name, int(max_mb * 1024 * 1024))
+        return c
+
+def all_stats() -> Dict[str, Dict[str, Any]]:
+    with _registry_lock:
+        caches = list(_registry.values())
+    return {c.name: c.stats() for c in caches}
+
+# ---------- Single-flight ----------
+class _Call:
+    __slots__ = ("done", "value", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller
+    runs ``fn``, callers arriving while it runs wait and get the same result
+    (or exception). Nothing is kept afterwards, so this complements an LRU
+    rather than replacing it. Shared results must be treated as read-only.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self._stats = {"leaders": 0, "shared": 0, "errors": 0}
+
+    def do(self, key: Hashable, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats["leaders"] += 1
+            else:
+                call.waiters += 1
+                self._stats["shared"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+_flights: Dict[str, SingleFlight] = {}
+
+def get_flight(name: str) -> SingleFlight:
+    """Process-wide named single-flight group, created on first use."""
+    with _registry_lock:
+        f = _flights.get(name)
+        if f is None:
+            f = _flights[name] = SingleFlight(name)
+        return f
+
+def flight_stats() -> Dict[str, Dict[str, Any]]:
+    with _registry_lock:
+        flights = list(_flights.values())
+    return {f.name: f.stats() for f in flights}
+
+def normalize_query(q: str) -> str:
+    return " ".join((q or "").lower().split())
@@ -0,0 +1,143 @@
+# app/services/compress.py
+from __future__ import annotations
+
+import dataclasses
+import logging
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import bm25, cache, config, embeddings, vectorstore
+
+log = logging.getLogger(__name__)
+
+# ---------- Extractive context compression ----------
+# Between retrieval and context packing, each hit is cut down to the
+# sentences that best match the query plus COMPRESS_NEIGHBORS sentences
+# on either side, kept in document order with " … " marking the gaps.
+# Hits keep their id, source and page, so citations are unchanged.
+#
+# Modes:
+#   embed    cosine between the query embedding and sentence embeddings;
+#            a chunk's sentences are embedded in one batch and cached by
+#            chunk id
+#   overlap  idf-weighted query term overlap (BM25 corpus idf), no model
+
+_SENT_SPLIT = re.compile(
+    r"(?<=[.!?;])\s+(?=[A-Z0-9(\"'•\-])"      # sentence end
+    r"|\n\s*\n"                                 # paragraph break
+    r"|\n(?=\s*(?:[-•*▪]|\d+[.)]|[a-z][.)])\s)"  # list item
+)
+_PUNCT = ".,;:!?()[]{}\"'“”‘’•*-–—/"
+
+_stats = {"calls": 0, "hits": 0, "sentences_in": 0, "sentences_kept": 0, "chars_in": 0, "chars_out": 0,
+          "errors": 0}
+
+def split_sentences(text: str) -> List[str]:
+    out = []
+    for s in _SENT_SPLIT.split(text or ""):
+        s = " ".join(s.split())
+        if s:
+            out.append(s)
+    return out
+
+def _terms(text: str) -> List[str]:
+    return [t for t in (w.strip(_PUNCT) for w in bm25.tokenize(text)) if t]
+
+def _embed_scores(q_vec: np.ndarray, split: List[List[str]], hits: List) -> List[np.ndarray]:
+    sc = cache.get_cache("sentence_embeddings", config.ENV.COMPRESS_CACHE_MB)
+    mats: List[np.ndarray | None] = []
+    todo: List[str] = []
+    for h, sents in zip(hits, split):
+        got = sc.get((config.ENV.EMBED_MODEL, h.id))
+        if got is not None and len(got) == len(sents):
+            mats.append(got)
+        else:
+            mats.append(None)
+            todo.extend(sents)
+    # one batched forward pass for every uncached sentence of every hit
+    vecs = embeddings.embed(todo)
+    pos = 0
+    for i, (h, sents) in enumerate(zip(hits, split)):
+        if mats[i] is None:
+            m = np.asarray(vecs[pos:pos + len(sents)], dtype=np.float32).reshape(len(sents), -1)
+            pos += len(sents)
+            sc.put((config.ENV.EMBED_MODEL, h.id), m)
+            mats[i] = m
+    q = np.asarray(q_vec, dtype=np.float32)
+    return [m @ q for m in mats]
+
+def _overlap_scores(query: str, split: List[List[str]]) -> List[np.ndarray]:
+    q_terms = set(_terms(query))
+    if not q_terms:
+        return [np.zeros(len(s), dtype=np.float32) for s in split]
+    idf = vectorstore.term_idf(sorted(q_terms))
+    out = []
+    for sents in split:
+        scores = np.zeros(len(sents), dtype=np.float32)
+        for j, s in enumerate(sents):
+            ts = _terms(s)
+            hit = q_terms.intersection(ts)
+            # length-damped so long run-on "sentences" (tables) don't win by size
+            scores[j] = sum(idf[t] for t in hit) / np.sqrt(1.0 + len(ts) / 20.0)
+        out.append(scores)
+    return out
+
+def _select(sents: List[str], scores: np.ndarray, keep: int, neighbors: int) -> Tuple[str, int]:
+    best = [j for j in np.argsort(-scores, kind="stable")[:keep].tolist() if scores[j] > 0]
+    chosen = set()
+    for j in best or [int(np.argmax(scores))]:
+        chosen.update(range(max(0, j - neighbors), min(len(sents), j + neighbors + 1)))
+    parts: List[str] = []
+    prev = -1
+    for j in sorted(chosen):
+        if j != prev + 1:
+            parts.append("…")
+        parts.append(sents[j])
+        prev = j
+    if prev < len(sents) - 1:
+        parts.append("…")
+    return " ".join(parts), len(chosen)
+
+def compress(query: str, hits: List, mode: str | None = None) -> List:
+    """Return copies of ``hits`` whose text is reduced to the query's best
+    sentences and their neighbours. Short hits, and all hits if scoring
+    fails, are returned unchanged."""
+    if not hits:
+        return hits
+    mode = (mode or config.ENV.COMPRESS_MODE).lower()
+    keep = max(1, config.ENV.COMPRESS_KEEP)
+    neighbors = max(0, config.ENV.COMPRESS_NEIGHBORS)
+    _stats["calls"] += 1
+    split = [split_sentences(h.text) for h in hits]
+    # only hits with more sentences than we'd keep are worth scoring
+    idx = [i for i in range(len(hits)) if len(split[i]) > keep * (2 * neighbors + 1)]
+    if not idx:
+        return hits
+    try:
+        if mode == "embed":
+            scores = _embed_scores(embeddings.embed_one(query), [split[i] for i in idx], [hits[i] for i in idx])
+        else:
+            scores = _overlap_scores(query, [split[i] for i in idx])
+    except Exception as e:
+        _stats["errors"] += 1
+        log.warning("Context compression failed (%s); sending full snippets", e)
+        return hits
+    out = list(hits)
+    for i, sc in zip(idx, scores):
+        text, kept = _select(split[i], sc, keep, neighbors)
+        out[i] = dataclasses.replace(hits[i], text=text)
+        _stats["hits"] += 1
+        _stats["sentences_in"] += len(split[i])
+        _stats["sentences_kept"] += kept
+        _stats["chars_in"] += len(hits[i].text)
+        _stats["chars_out"] += len(text)
+    return out
+
+def stats() -> Dict:
+    st = dict(_stats)
+    st["enabled"] = config.ENV.CONTEXT_COMPRESS
+    st["mode"] = config.ENV.COMPRESS_MODE
+    st["char_ratio"] = round(st["chars_out"] / st["chars_in"], 3) if st["chars_in"] else 1.0
+    return st
@@ -31,12 +31,43 @@ class _Env(BaseModel):
 
     # OCR / Tesseract settings
     TESSERACT_LANGS: str = os.getenv("TESSERACT_LANGS", "eng")  # e.g. "eng+hin"
-    OCR_DPI_SCALE: float = float(os.getenv("OCR_DPI_SCALE", "2.0"))
+    OCR_DPI_SCALE: float = float(os.getenv("OCR_DPI_SCALE", "2.0"))  # fallback when scan DPI is unknown
+    OCR_MIN_DPI: float = float(os.getenv("OCR_MIN_DPI", "150"))
+    # Tesseract is tuned for ~300 DPI text; OCR time grows with pixel count
+    # (dpi^2), so higher caps mostly buy time, not accuracy. Raise it only for
+    # very small print (< 8pt).
+    OCR_MAX_DPI: float = float(os.getenv("OCR_MAX_DPI", "300"))
     MIN_EXTRACTED_TEXT: int = int(os.getenv("MIN_EXTRACTED_TEXT", "25"))
 
+    # Ingest parallelism (page extraction / OCR process pool)
+    INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", "0"))  # 0 = cpu_count - 1
+    INGEST_PAGES_PER_TASK: int = int(os.getenv("INGEST_PAGES_PER_TASK", "4"))
+    # Streaming ingest pipeline: items buffered between stages, chunks per Chroma upsert
+    INGEST_QUEUE_SIZE: int = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+    INGEST_UPSERT_BATCH: int = int(os.getenv("INGEST_UPSERT_BATCH", "256"))
+    # Background ingest jobs: concurrent jobs per process, idle poll interval (s)
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "1"))
+    JOB_POLL_SECONDS: float = float(os.getenv("JOB_POLL_SECONDS", "2.0"))
+    UPLOAD_CHUNK_BYTES: int = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1 << 20)))
+
     # Embeddings
     EMBED_MODEL: str = os.getenv("EMBED_MODEL", "intfloat/multilingual-e5-small")
     EMBED_BATCH: int = int(os.getenv("EMBED_BATCH", "64"))
+    # Query embeddings from concurrent requests are coalesced for up to this long (0 = off)
+    EMBED_BATCH_WAIT_MS: float = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+    # In-process LRU caches (MB, 0 = off); results are dropped when the corpus changes
+    EMBED_QUERY_CACHE_MB: float = float(os.getenv("EMBED_QUERY_CACHE_MB", "16"))
+    QUERY_CACHE_MB: float = float(os.getenv("QUERY_CACHE_MB", "64"))
+    DOCSTORE_CACHE_MB: float = float(os.getenv("DOCSTORE_CACHE_MB", "32"))  # hot chunk texts
+    # Semantic answer cache: reuse an answer for a similar query over the same retrieved chunks
+    ANSWER_CACHE: bool = os.getenv("ANSWER_CACHE", "true").lower() == "true"
+    ANSWER_CACHE_SIM: float = float(os.getenv("ANSWER_CACHE_SIM", "0.95"))
+    ANSWER_CACHE_MAX: int = int(os.getenv("ANSWER_CACHE_MAX", "2000"))
+    ANSWER_CACHE_TTL_S: float = float(os.getenv("ANSWER_CACHE_TTL_S", str(7 * 24 * 3600)))
+    # Persistent (model, text-hash) -> vector cache used at ingest
+    EMBED_CACHE: bool = os.getenv("EMBED_CACHE", "true").lower() == "true"
+    EMBED_CACHE_DTYPE: str = os.getenv("EMBED_CACHE_DTYPE", "float16")  # or "float32"
 
     # Chunking
     CHUNK_TOKENS: int = int(os.getenv("CHUNK_TOKENS", "600"))
@@ -48,17 +79,47 @@ class _Env(BaseModel):
     TOPK_AFTER_MMR: int = int(os.getenv("TOPK_AFTER_MMR", "10"))
     HYBRID_WEIGHT_DENSE: float = float(os.getenv("HYBRID_WEIGHT_DENSE", "0.55"))
     HYBRID_WEIGHT_BM25: float = float(os.getenv("HYBRID_WEIGHT_BM25", "0.45"))
+    FUSION_STRATEGY: str = os.getenv("FUSION_STRATEGY", "weighted")  # or "rrf"
+    RRF_K: float = float(os.getenv("RRF_K", "60"))
     MMR_LAMBDA: float = float(os.getenv("MMR_LAMBDA", "0.6"))
+    # LLM context budget in tokens (0 = derive from the request's max_context_chars at ~4 chars/token)
+    CONTEXT_MAX_TOKENS: int = int(os.getenv("CONTEXT_MAX_TOKENS", "0"))
+    # Extractive compression: keep each hit's best sentences (+ neighbours) before packing
+    CONTEXT_COMPRESS: bool = os.getenv("CONTEXT_COMPRESS", "false").lower() == "true"
+    COMPRESS_MODE: str = os.getenv("COMPRESS_MODE", "embed").lower()  # or "overlap" (BM25 idf, no model)
+    COMPRESS_KEEP: int = int(os.getenv("COMPRESS_KEEP", "3"))  # best sentences per hit
+    COMPRESS_NEIGHBORS: int = int(os.getenv("COMPRESS_NEIGHBORS", "1"))
+    COMPRESS_CACHE_MB: float = float(os.getenv("COMPRESS_CACHE_MB", "16"))  # sentence embeddings per chunk
 
     # Optional reranker (cross-encoder)
     USE_RERANKER: bool = os.getenv("USE_RERANKER", "false").lower() == "true"
     RERANKER_MODEL: str = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-base")
     RERANK_TOPN: int = int(os.getenv("RERANK_TOPN", "20"))
+    RERANK_MAX_TOKENS: int = int(os.getenv("RERANK_MAX_TOKENS", "256"))  # per (query, chunk) pair
+    RERANK_BUDGET_MS: float = float(os.getenv("RERANK_BUDGET_MS", "400"))  # else keep fused order
+    RERANK_CACHE_MB: float = float(os.getenv("RERANK_CACHE_MB", "4"))
 
     # LLM Provider settings
     LLM_PROVIDER: str = os.getenv("LLM_PROVIDER", "openai").lower()
     OPENAI_API_KEY: str | None = os.getenv("OPENAI_API_KEY")
     OPENAI_MODEL: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    OPENAI_BASE_URL: str | None = os.getenv("OPENAI_BASE_URL")  # any chat-completions compatible server
+    # Pooled client: connections per provider, per-attempt timeout, overall deadline (s)
+    LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+    LLM_TIMEOUT_S: float = float(os.getenv("LLM_TIMEOUT_S", "60"))
+    LLM_DEADLINE_S: float = float(os.getenv("LLM_DEADLINE_S", "90"))
+    # Retries of transient errors (timeouts, 429, 5xx) with full-jitter backoff
+    LLM_RETRIES: int = int(os.getenv("LLM_RETRIES", "2"))
+    LLM_RETRY_BASE_MS: float = float(os.getenv("LLM_RETRY_BASE_MS", "500"))
+    # Hedging: race a duplicate request once the first passes the provider's p95 latency
+    LLM_HEDGE: bool = os.getenv("LLM_HEDGE", "false").lower() == "true"
+    LLM_HEDGE_MIN_MS: float = float(os.getenv("LLM_HEDGE_MIN_MS", "1500"))
+    LLM_HEDGE_RATIO: float = float(os.getenv("LLM_HEDGE_RATIO", "0.05"))  # max share of calls hedged
+    # LLM_PROVIDER=stub: offline answers with simulated latency; LLM_STUB_ROUTE serves
+    # them at /v1/chat/completions for load tests through the openai provider
+    LLM_STUB_TTFT_MS: float = float(os.getenv("LLM_STUB_TTFT_MS", "300"))
+    LLM_STUB_TOKEN_MS: float = float(os.getenv("LLM_STUB_TOKEN_MS", "15"))
+    LLM_STUB_ROUTE: bool = os.getenv("LLM_STUB_ROUTE", "false").lower() == "true"
 
     # Chroma batch optimization
     CHROMA_BATCH_SIZE: int = int(os.getenv("CHROMA_BATCH_SIZE", "1000"))
@@ -0,0 +1,179 @@
+# app/services/context_pack.py
+from __future__ import annotations
+
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List
+
+from . import cache, chunking, config
+
+log = logging.getLogger(__name__)
+
+# ---------- Token-budgeted context packing ----------
+# Snippets are taken in retrieval order (already fused, reranked and
+# diversified) and packed whole while they fit the token budget; lower
+# ranked snippets that still fit are taken after a larger one is skipped,
+# and the best skipped snippet is cut at a token boundary to use what is
+# left. Text another packed snippet of the same source already carries
+# (smart_chunk's overlap, or a chunk contained in another) is trimmed or
+# dropped. Token counts come from tiktoken for the configured model, or
+# the ~4 chars/token estimate used by chunking when tiktoken is missing;
+# per-chunk counts are cached by chunk id.
+
+_MIN_TAIL_TOKENS = 48     # smallest truncated snippet worth sending
+_MIN_OVERLAP_CHARS = 40   # shorter shared text is coincidence, not chunk overlap
+_COUNT_CACHE_MB = 2
+
+_enc = None
+_enc_name = ""
+_enc_lock = threading.Lock()
+
+def _encoder():
+    global _enc, _enc_name
+    if not _enc_name:
+        with _enc_lock:
+            if not _enc_name:
+                try:
+                    import tiktoken
+                    try:
+                        _enc = tiktoken.encoding_for_model(config.ENV.OPENAI_MODEL)
+                    except KeyError:
+                        _enc = tiktoken.get_encoding("cl100k_base")
+                    _enc_name = _enc.name
+                except Exception as e:
+                    log.warning("tiktoken unavailable (%s); estimating ~4 chars per token", e)
+                    _enc, _enc_name = None, "approx"
+    return _enc
+
+def count_tokens(text: str) -> int:
+    enc = _encoder()
+    if enc is None:
+        return chunking._approx_tokens(text) if text else 0
+    return len(enc.encode(text, disallowed_special=()))
+
+def _cut(text: str, max_tokens: int) -> str:
+    """Longest prefix of ``text`` within ``max_tokens``."""
+    enc = _encoder()
+    if enc is None:
+        return text[: max(0, max_tokens) * 4]
+    toks = enc.encode(text, disallowed_special=())
+    return enc.decode(toks[: max(0, max_tokens)])
+
+def _chunk_tokens(chunk_id: str, text: str) -> int:
+    counts = cache.get_cache("token_counts", _COUNT_CACHE_MB)
+    # the text hash tells a compressed hit apart from its full chunk
+    key = (_enc_name or "", chunk_id, hash(text))
+    n = counts.get(key)
+    if n is None:
+        n = count_tokens(text)
+        counts.put(key, n, nbytes=28)
+    return n
+
+def _flatten(text: str) -> str:
+    return " ".join((text or "").split())
+
+def _overlap(prev: str, new: str) -> int:
+    """Length of the longest suffix of ``prev`` that is a prefix of ``new``."""
+    head = new[:_MIN_OVERLAP_CHARS]
+    if len(head) < _MIN_OVERLAP_CHARS:
+        return 0
+    start = max(0, len(prev) - len(new))
+    while True:
+        p = prev.find(head, start)
+        if p < 0:
+            return 0
+        if new.startswith(prev[p:]):
+            return len(prev) - p
+        start = p + 1
+
+@dataclass
+class Packed:
+    context: str
+    citations: List[Dict]
+    hits: List                       # hits that made it into the context, in order
+    tokens: int
+    budget: int
+    truncated: int = 0               # snippets cut to fit
+    deduped: int = 0                 # snippets trimmed or dropped as repeated text
+    dropped: int = 0                 # snippets left out for lack of budget
+    encoding: str = ""
+
+def _header(n: int, h) -> str:
+    return f"[{n}] Source: {h.source} (p.{h.page})\n"
+
+def pack(hits: List, max_tokens: int) -> Packed:
+    """Pack ``hits`` (best first) into a numbered context of at most
+    ``max_tokens`` tokens; citations are numbered as in the context."""
+    budget = max(0, int(max_tokens))
+    sep = count_tokens("\n\n")
+    # 1. dedupe and measure
+    bodies: List[tuple] = []    # (hit, text, tokens)
+    seen: Dict[str, List[str]] = {}
+    deduped = 0
+    for h in hits:
+        txt = _flatten(h.text)
+        if not txt:
+            continue
+        prior = seen.setdefault(h.source, [])
+        if any(txt in p for p in prior):
+            deduped += 1
+            continue
+        cut = max((_overlap(p, txt) for p in prior), default=0)
+        if cut:
+            deduped += 1
+            txt = txt[cut:].strip()
+            if len(txt) < _MIN_OVERLAP_CHARS:
+                continue
+            n = count_tokens(txt)
+        else:
+            n = _chunk_tokens(h.id, txt)
+        prior.append(_flatten(h.text))
+        bodies.append((h, txt, n))
+
+    # 2. whole snippets in rank order while they fit (numbering is assigned
+    #    afterwards, so headers are costed with a generous placeholder)
+    used = 0
+    chosen: List[tuple] = []    # (rank, hit, text)
+    skipped: List[int] = []
+    for rank, (h, txt, n) in enumerate(bodies):
+        cost = count_tokens(_header(99, h)) + n + (sep if chosen else 0)
+        if used + cost <= budget:
+            chosen.append((rank, h, txt))
+            used += cost
+        else:
+            skipped.append(rank)
+
+    # 3. cut the best skipped snippet into the remaining budget
+    truncated = 0
+    if skipped:
+        rank = skipped[0]
+        h, txt, _ = bodies[rank]
+        room = budget - used - count_tokens(_header(99, h)) - (sep if chosen else 0) - 1
+        if room >= _MIN_TAIL_TOKENS:
+            chosen.append((rank, h, _cut(txt, room).rstrip() + " …"))
+            chosen.sort(key=lambda c: c[0])
+            truncated = 1
+
+    pieces: List[str] = []
+    cits: List[Dict] = []
+    for n, (_, h, txt) in enumerate(chosen, start=1):
+        pieces.append(_header(n, h) + txt)
+        cits.append({"n": n, "source": h.source, "page": h.page})
+    context = "\n\n".join(pieces)
+    tokens = count_tokens(context) if context else 0
+    if tokens > budget:
+        # BPE merges across joins can shift the total by a token or two
+        context = _cut(context, budget)
+        tokens = count_tokens(context)
+    return Packed(
+        context=context,
+        citations=cits,
+        hits=[h for _, h, _ in chosen],
+        tokens=tokens,
+        budget=budget,
+        truncated=truncated,
+        deduped=deduped,
+        dropped=len(bodies) - len(chosen),
+        encoding=_enc_name,
+    )
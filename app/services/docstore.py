@@ -0,0 +1,106 @@
+# app/services/docstore.py
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import cache, config
+
+log = logging.getLogger(__name__)
+
+# ---------- Local document store ----------
+# id -> (text, metadata) for every chunk in the collection, so hybrid search
+# can assemble BM25-only hits without a second Chroma round trip. SQLite
+# (memory-mapped reads, WAL) shared by all workers, fronted by a per-process
+# LRU of hot chunks. Hot entries carry the corpus version they were read
+# at, so an upsert in another worker (seen here through the BM25 journal)
+# retires them even when the chunk id is unchanged. Chroma remains the source
+# of truth: open() rebuilds the store from it when the two disagree.
+
+DB_PATH = config.VECTOR_DIR / "docstore.sqlite3"
+
+Doc = Tuple[str, Dict]  # (text, metadata)
+
+class DocStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA mmap_size=268435456")
+        self._db.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, text TEXT NOT NULL, meta TEXT NOT NULL)")
+        self._hot = cache.get_cache("docstore", config.ENV.DOCSTORE_CACHE_MB)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0])
+
+    def get_many(self, ids: List[str], version: Optional[int] = None) -> Dict[str, Doc]:
+        """``version`` is the caller's corpus version; hot entries read at
+        another version are re-read from SQLite."""
+        out: Dict[str, Doc] = {}
+        todo: List[str] = []
+        for i in dict.fromkeys(ids):
+            d = self._hot.get(i, version)
+            if d is None:
+                todo.append(i)
+            else:
+                out[i] = d
+        if not todo:
+            return out
+        with self._lock:
+            for j in range(0, len(todo), 500):
+                part = todo[j:j + 500]
+                q = "SELECT id, text, meta FROM docs WHERE id IN (%s)" % ",".join("?" * len(part))
+                for _id, text, meta in self._db.execute(q, part):
+                    d = (text, json.loads(meta))
+                    out[_id] = d
+                    self._hot.put(_id, d, version)
+        return out
+
+    def put_many(self, ids: List[str], texts: List[str], metas: List[Dict]) -> None:
+        rows = [(i, t or "", json.dumps(m or {}, ensure_ascii=False)) for i, t, m in zip(ids, texts, metas)]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)", rows)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        for i in ids:
+            self._hot.discard(i)
+
+    def delete(self, ids: List[str]) -> None:
+        with self._lock:
+            for j in range(0, len(ids), 500):
+                part = ids[j:j + 500]
+                self._db.execute("DELETE FROM docs WHERE id IN (%s)" % ",".join("?" * len(part)), part)
+        for i in ids:
+            self._hot.discard(i)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM docs")
+        self._hot.clear()
+
+    def rebuild(self, batches: Iterable[Tuple[List[str], List[str], List[Dict]]]) -> int:
+        self.clear()
+        n = 0
+        for ids, texts, metas in batches:
+            self.put_many(ids, texts, metas)
+            n += len(ids)
+        return n
+
+
+_store: Optional[DocStore] = None
+_store_lock = threading.Lock()
+
+def get_store() -> DocStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DocStore(DB_PATH)
+        return _store
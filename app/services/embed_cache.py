@@ -0,0 +1,176 @@
+# app/services/embed_cache.py
+from __future__ import annotations
+
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from . import config, embeddings
+
+log = logging.getLogger(__name__)
+
+# ---------- Store ----------
+# One directory per embedding model:
+#   vectors.bin    fixed-width rows (float16 or float32), append-only
+#   index.sqlite3  sha256(text) -> row number
+# Rows are appended inside an IMMEDIATE transaction, so several workers can
+# share the cache without handing out the same row twice.
+
+def _text_key(text: str) -> bytes:
+    return hashlib.sha256((text or "").encode("utf-8")).digest()
+
+def _model_dir(model: str) -> Path:
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model).strip("_") or "model"
+    return config.VECTOR_DIR / "embed_cache" / slug
+
+
+class EmbeddingCache:
+    def __init__(self, model: str, dtype: str = "float16"):
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.dir = _model_dir(model)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._vec_path = self.dir / "vectors.bin"
+        self._vec_path.touch(exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.dir / "index.sqlite3"), check_same_thread=False,
+                                   isolation_level=None, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, row INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._dim: Optional[int] = self._read_meta_dim()
+        self._map: Optional[np.memmap] = None
+
+    def _read_meta_dim(self) -> Optional[int]:
+        row = self._db.execute("SELECT value FROM meta WHERE name='dim'").fetchone()
+        dtype = self._db.execute("SELECT value FROM meta WHERE name='dtype'").fetchone()
+        if dtype and dtype[0] != self.dtype.str:
+            self.dtype = np.dtype(dtype[0])  # keep reading the store as written
+        return int(row[0]) if row else None
+
+    def _rows(self, need_row: int) -> Optional[np.memmap]:
+        if not self._dim:
+            return None
+        if self._map is None or need_row >= self._map.shape[0]:
+            n = self._vec_path.stat().st_size // (self._dim * self.dtype.itemsize)
+            if n == 0:
+                return None
+            self._map = np.memmap(self._vec_path, dtype=self.dtype, mode="r", shape=(n, self._dim))
+        return self._map
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        out: List[Optional[np.ndarray]] = [None] * len(texts)
+        if not texts:
+            return out
+        keys = [_text_key(t) for t in texts]
+        rows: dict = {}
+        with self._lock:
+            if self._dim is None:
+                self._dim = self._read_meta_dim()
+            for i in range(0, len(keys), 500):
+                part = list(set(keys[i:i + 500]))
+                q = "SELECT key, row FROM entries WHERE key IN (%s)" % ",".join("?" * len(part))
+                rows.update(self._db.execute(q, part).fetchall())
+            if not rows:
+                return out
+            m = self._rows(max(rows.values()))
+            if m is None:
+                return out
+            for i, k in enumerate(keys):
+                r = rows.get(k)
+                if r is not None and r < m.shape[0]:
+                    out[i] = np.array(m[r], dtype=np.float32)
+        return out
+
+    def put_many(self, texts: List[str], vecs: List[np.ndarray]) -> None:
+        if not texts:
+            return
+        mat = np.asarray(np.stack([np.asarray(v, dtype=np.float32) for v in vecs]), dtype=self.dtype)
+        keys = [_text_key(t) for t in texts]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._dim is None:
+                    self._dim = self._read_meta_dim()
+                if self._dim is None:
+                    self._dim = int(mat.shape[1])
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self._dim),))
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dtype', ?)", (self.dtype.str,))
+                if mat.shape[1] != self._dim:
+                    log.warning("Embedding dim %d != cache dim %d for %s; not caching",
+                                mat.shape[1], self._dim, self.model)
+                    self._db.execute("ROLLBACK")
+                    return
+                existing = set()
+                for i in range(0, len(keys), 500):
+                    part = list(set(keys[i:i + 500]))
+                    q = "SELECT key FROM entries WHERE key IN (%s)" % ",".join("?" * len(part))
+                    existing.update(k for (k,) in self._db.execute(q, part).fetchall())
+                new_idx, seen = [], set(existing)
+                for i, k in enumerate(keys):
+                    if k not in seen:
+                        seen.add(k)
+                        new_idx.append(i)
+                if new_idx:
+                    row_bytes = self._dim * self.dtype.itemsize
+                    with open(self._vec_path, "r+b") as f:
+                        f.seek(0, 2)
+                        start = f.tell() // row_bytes
+                        f.seek(start * row_bytes)  # drop a torn tail row, if any
+                        f.write(np.ascontiguousarray(mat[new_idx]).data)
+                        f.flush()
+                    self._db.executemany(
+                        "INSERT INTO entries VALUES (?, ?)",
+                        [(keys[i], start + j) for j, i in enumerate(new_idx)],
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+
+_caches: dict = {}
+_caches_lock = threading.Lock()
+
+def get_cache() -> Optional[EmbeddingCache]:
+    if not config.ENV.EMBED_CACHE:
+        return None
+    model = config.ENV.EMBED_MODEL
+    with _caches_lock:
+        if model not in _caches:
+            try:
+                _caches[model] = EmbeddingCache(model, dtype=config.ENV.EMBED_CACHE_DTYPE)
+            except Exception as e:
+                log.warning("Embedding cache unavailable (%s); embedding without it", e)
+                _caches[model] = None
+        return _caches[model]
+
+def embed_cached(texts: List[str]) -> List[np.ndarray]:
+    """Like embeddings.embed, but only cache misses go to the model."""
+    cache = get_cache()
+    if cache is None:
+        return embeddings.embed(texts)
+    try:
+        out = cache.get_many(texts)
+    except Exception as e:
+        log.warning("Embedding cache read failed: %s", e)
+        return embeddings.embed(texts)
+    miss = [i for i, v in enumerate(out) if v is None]
+    if miss:
+        uniq = list(dict.fromkeys(texts[i] for i in miss))
+        vecs = embeddings.embed(uniq)
+        by_text = dict(zip(uniq, vecs))
+        for i in miss:
+            out[i] = by_text[texts[i]]
+        try:
+            cache.put_many(uniq, vecs)
+        except Exception as e:
+            log.warning("Embedding cache write failed: %s", e)
+    log.debug("embed_cached: %d texts, %d cache hits", len(texts), len(texts) - len(miss))
+    return out
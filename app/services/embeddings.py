@@ -1,10 +1,15 @@
 # app/services/embeddings.py
 from __future__ import annotations
-from typing import List
+from typing import Dict, List, Optional
+from collections import deque
+import logging
 import threading
+import time
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from . import config
+from . import cache, config
+
+log = logging.getLogger(__name__)
 
 _model_lock = threading.Lock()
 _model: SentenceTransformer | None = None
@@ -32,6 +37,137 @@ def embed(texts: List[str]) -> List[np.ndarray]:
             out.extend([np.array(v, dtype=np.float32) for v in vecs])
     return out
 
+# ---------- Query micro-batching ----------
+class _Request:
+    __slots__ = ("texts", "done", "result", "error")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result: Optional[List[np.ndarray]] = None
+        self.error: Optional[BaseException] = None
+
+class _Batcher:
+    """
+    Coalesces embedding requests from concurrent callers into one
+    ``encode`` call. The worker thread waits at most ``max_wait`` seconds
+    after the first pending request, or until ``max_batch`` texts are
+    pending, then embeds everything it took in one forward pass.
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self._cv = threading.Condition()
+        self._pending: deque[_Request] = deque()
+        self._n_pending = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"batches": 0, "requests": 0, "texts": 0, "max_batch": 0}
+        self._sizes: Dict[int, int] = {}  # texts per forward pass -> count
+
+    def submit(self, texts: List[str]) -> List[np.ndarray]:
+        req = _Request(texts)
+        with self._cv:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(req)
+            self._n_pending += len(texts)
+            self._cv.notify()
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result or []
+
+    def _take(self) -> List[_Request]:
+        with self._cv:
+            while not self._pending:
+                self._cv.wait()
+            deadline = time.monotonic() + self.max_wait
+            while self._n_pending < self.max_batch:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cv.wait(left)
+            taken: List[_Request] = []
+            n = 0
+            while self._pending and (not taken or n + len(self._pending[0].texts) <= self.max_batch):
+                req = self._pending.popleft()
+                taken.append(req)
+                n += len(req.texts)
+            self._n_pending -= n
+            return taken
+
+    def _run(self) -> None:
+        while True:
+            reqs = self._take()
+            uniq = list(dict.fromkeys(t for r in reqs for t in r.texts))
+            try:
+                by_text = dict(zip(uniq, embed(uniq)))
+                for r in reqs:
+                    r.result = [by_text[t] for t in r.texts]
+            except BaseException as e:
+                log.warning("Batched embedding failed: %s", e)
+                for r in reqs:
+                    r.error = e
+            finally:
+                for r in reqs:
+                    r.done.set()
+            with self._cv:
+                st = self._stats
+                st["batches"] += 1
+                st["requests"] += len(reqs)
+                st["texts"] += len(uniq)
+                st["max_batch"] = max(st["max_batch"], len(uniq))
+                self._sizes[len(uniq)] = self._sizes.get(len(uniq), 0) + 1
+
+    def stats(self) -> Dict:
+        with self._cv:
+            st = dict(self._stats)
+            st["mean_batch"] = round(st["texts"] / st["batches"], 2) if st["batches"] else 0.0
+            st["mean_requests_per_batch"] = round(st["requests"] / st["batches"], 2) if st["batches"] else 0.0
+            st["batch_sizes"] = dict(sorted(self._sizes.items()))
+            st["max_wait_ms"] = self.max_wait * 1000.0
+            st["max_batch_size"] = self.max_batch
+            return st
+
+_batcher: Optional[_Batcher] = None
+_batcher_lock = threading.Lock()
+
+def _get_batcher() -> Optional[_Batcher]:
+    global _batcher
+    wait_ms = float(getattr(config.ENV, "EMBED_BATCH_WAIT_MS", 5.0))
+    if wait_ms <= 0:
+        return None
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = _Batcher(config.ENV.EMBED_BATCH, wait_ms / 1000.0)
+        return _batcher
+
+def embed_queries(texts: List[str]) -> List[np.ndarray]:
+    """Embed latency-sensitive query texts, sharing a forward pass with
+    other requests that arrive within EMBED_BATCH_WAIT_MS."""
+    if not texts:
+        return []
+    qc = cache.get_cache("query_embeddings", config.ENV.EMBED_QUERY_CACHE_MB)
+    # exact text: the tokenizer is case-sensitive, so normalize_query() keys
+    # would hand "WLL" the vector computed for "wll"
+    keys = [(config.ENV.EMBED_MODEL, t) for t in texts]
+    out: List[Optional[np.ndarray]] = [qc.get(k) for k in keys] if qc.enabled else [None] * len(texts)
+    miss = [i for i, v in enumerate(out) if v is None]
+    if miss:
+        todo = [texts[i] for i in miss]
+        b = _get_batcher()
+        vecs = b.submit(todo) if b is not None else embed(todo)
+        for i, v in zip(miss, vecs):
+            out[i] = v
+            qc.put(keys[i], v)
+    return out
+
+def batcher_stats() -> Dict:
+    b = _batcher
+    return b.stats() if b is not None else {"batches": 0}
+
 def embed_one(text: str) -> np.ndarray:
-    vecs = embed([text])
+    vecs = embed_queries([text])
     return vecs[0] if vecs else np.zeros((384,), dtype=np.float32)
@@ -1,19 +1,120 @@
 # app/services/expand.py
 from __future__ import annotations
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from collections import deque
 import json
+import os
+import threading
+import time
 from pathlib import Path
 
 # Path to your JSON file
 ALIASES_PATH = Path(__file__).resolve().parents[1] / "data" / "rigging_aliases.json"
 
-# Load aliases from JSON
-try:
-    with open(ALIASES_PATH, "r", encoding="utf-8") as f:
-        ALIASES: Dict[str, List[str]] = json.load(f)
-except Exception as e:
-    print(f"[expand] Failed to load aliases from {ALIASES_PATH}: {e}")
-    ALIASES = {}
+# Seconds between mtime checks of the aliases file
+RELOAD_CHECK_SECONDS = 2.0
+
+
+class _AliasMatcher:
+    """
+    Aho-Corasick automaton over the lowercased alias keys and variants.
+    A match only counts on token boundaries (no alphanumeric character
+    directly before or after it), so "wll" matches "wll of shackle" but
+    not "swll". One linear pass over the query finds every alias group.
+    """
+
+    def __init__(self, aliases: Dict[str, List[str]]):
+        self.groups: List[List[str]] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, int]]] = [[]]  # (pattern length, group)
+        for g, (key, variants) in enumerate(aliases.items()):
+            self.groups.append([key, *variants])
+            for pat in {p.strip().lower() for p in (key, *variants) if p and p.strip()}:
+                self._insert(pat, g)
+        self._build_links()
+
+    def _insert(self, pat: str, group: int) -> None:
+        node = 0
+        for ch in pat:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({}); self._fail.append(0); self._out.append([])
+            node = nxt
+        self._out[node].append((len(pat), group))
+
+    def _build_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0) if node else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match_groups(self, text: str) -> List[int]:
+        """Indices of alias groups found in ``text`` (lowercased), in table order."""
+        found = set()
+        node = 0
+        n = len(text)
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length, group in self._out[node]:
+                if group in found:
+                    continue
+                start, end = i - length + 1, i + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == n or not text[end].isalnum()):
+                    found.add(group)
+        return sorted(found)
+
+
+def _load() -> Tuple[float, Dict[str, List[str]], _AliasMatcher]:
+    try:
+        mtime = os.path.getmtime(ALIASES_PATH)
+        with open(ALIASES_PATH, "r", encoding="utf-8") as f:
+            aliases: Dict[str, List[str]] = json.load(f)
+    except Exception as e:
+        print(f"[expand] Failed to load aliases from {ALIASES_PATH}: {e}")
+        mtime, aliases = 0.0, {}
+    return mtime, aliases, _AliasMatcher(aliases)
+
+
+# (mtime, aliases, matcher) is swapped as one tuple so readers never see a
+# matcher that does not belong to the alias table next to it
+_STATE = _load()
+ALIASES: Dict[str, List[str]] = _STATE[1]
+_reload_lock = threading.Lock()
+_last_check = time.monotonic()
+
+
+def _current() -> Tuple[float, Dict[str, List[str]], _AliasMatcher]:
+    """Return the compiled state, recompiling if the JSON file changed."""
+    global _STATE, ALIASES, _last_check
+    now = time.monotonic()
+    if now - _last_check < RELOAD_CHECK_SECONDS or not _reload_lock.acquire(blocking=False):
+        return _STATE
+    try:
+        _last_check = now
+        try:
+            mtime = os.path.getmtime(ALIASES_PATH)
+        except OSError:
+            return _STATE
+        if mtime != _STATE[0]:
+            state = _load()
+            if state[1] or not _STATE[1]:
+                _STATE = state
+                ALIASES = state[1]
+                print(f"[expand] Reloaded {len(ALIASES)} alias groups from {ALIASES_PATH}")
+        return _STATE
+    finally:
+        _reload_lock.release()
 
 def _uniq_keep_order(items: List[str]) -> List[str]:
     seen = set(); out = []
@@ -31,12 +132,11 @@ def expanded_queries(q: str, max_variants: int = 6) -> List[str]:
     to improve retrieval recall.
     """
     out: List[str] = [q]
-    ql = q.lower()
+    matcher = _current()[2]
 
     # If the query already contains a known acronym or alias, add its variants
-    for key, variants in ALIASES.items():
-        if key.lower() in ql or any(v.lower() in ql for v in variants):
-            out.extend([key, *variants])
+    for g in matcher.match_groups(q.lower()):
+        out.extend(matcher.groups[g])
 
     out = _uniq_keep_order(out)
     return out[:max_variants]
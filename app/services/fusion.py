@@ -0,0 +1,83 @@
+# app/services/fusion.py
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from . import config
+
+# ---------- Hybrid score fusion ----------
+# Inputs are aligned float arrays over one query's candidates, with NaN
+# where a retriever did not return the candidate. Each strategy returns
+# (dense component, bm25 component, fused score); the fused score is what
+# ranking, MMR and /search use, stored once on SearchHit.score.
+
+@dataclass(frozen=True)
+class FusionParams:
+    strategy: str = "weighted"
+    w_dense: float = 0.55
+    w_bm25: float = 0.45
+    rrf_k: float = 60.0
+
+    def key(self) -> Tuple:
+        return (self.strategy, self.w_dense, self.w_bm25, self.rrf_k)
+
+def params(overrides: Optional[Dict] = None) -> FusionParams:
+    """Defaults from config, with optional per-request ``overrides``
+    (strategy, w_dense, w_bm25, rrf_k)."""
+    o = dict(overrides or {})
+    unknown = set(o) - {"strategy", "w_dense", "w_bm25", "rrf_k"}
+    if unknown:
+        raise ValueError(f"unknown fusion options {sorted(unknown)}")
+    p = FusionParams(
+        strategy=str(o.get("strategy") or config.ENV.FUSION_STRATEGY),
+        w_dense=float(o.get("w_dense", config.ENV.HYBRID_WEIGHT_DENSE)),
+        w_bm25=float(o.get("w_bm25", config.ENV.HYBRID_WEIGHT_BM25)),
+        rrf_k=float(o.get("rrf_k", config.ENV.RRF_K)),
+    )
+    if p.strategy not in STRATEGIES:
+        raise ValueError(f"unknown fusion strategy {p.strategy!r}; expected one of {sorted(STRATEGIES)}")
+    if p.w_dense < 0 or p.w_bm25 < 0 or p.w_dense + p.w_bm25 <= 0:
+        raise ValueError("fusion weights must be non-negative and not both zero")
+    return p
+
+def normalize(scores: np.ndarray) -> np.ndarray:
+    """z-score then min-max to [0, 1]; near-constant inputs are scaled by
+    their max magnitude instead."""
+    arr = np.asarray(scores, dtype=np.float32)
+    if arr.size == 0:
+        return arr
+    std = float(arr.std())
+    if std < 1e-6:
+        return arr / (np.abs(arr).max() + 1e-6)
+    z = (arr - arr.mean()) / (std + 1e-6)
+    return (z - z.min()) / (z.max() - z.min() + 1e-6)
+
+def _weighted(dense: np.ndarray, bm25: np.ndarray, p: FusionParams):
+    nd = normalize(np.nan_to_num(dense, nan=0.0))
+    nb = normalize(np.nan_to_num(bm25, nan=0.0))
+    return nd, nb, p.w_dense * nd + p.w_bm25 * nb
+
+def _ranks(scores: np.ndarray) -> np.ndarray:
+    """1-based rank among present (non-NaN) scores; inf where absent."""
+    ranks = np.full(scores.shape, np.inf, dtype=np.float32)
+    present = np.flatnonzero(~np.isnan(scores))
+    order = present[np.argsort(-scores[present], kind="stable")]
+    ranks[order] = np.arange(1, len(order) + 1, dtype=np.float32)
+    return ranks
+
+def _rrf(dense: np.ndarray, bm25: np.ndarray, p: FusionParams):
+    # weighted reciprocal rank fusion, scaled so rank 1 on both sides = 1.0
+    rd = 1.0 / (p.rrf_k + _ranks(dense))
+    rb = 1.0 / (p.rrf_k + _ranks(bm25))
+    top = (p.w_dense + p.w_bm25) / (p.rrf_k + 1.0)
+    return rd * (p.rrf_k + 1.0), rb * (p.rrf_k + 1.0), (p.w_dense * rd + p.w_bm25 * rb) / top
+
+STRATEGIES: Dict[str, Callable] = {"weighted": _weighted, "rrf": _rrf}
+
+def fuse(dense: np.ndarray, bm25: np.ndarray, p: Optional[FusionParams] = None
+         ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    p = p or params()
+    return STRATEGIES[p.strategy](np.asarray(dense, dtype=np.float32), np.asarray(bm25, dtype=np.float32), p)
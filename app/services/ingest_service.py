@@ -1,38 +1,17 @@
 # app/services/ingest_service.py
 from __future__ import annotations
-from typing import List, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from pathlib import Path
-import io
 import logging
+import queue
+import threading
 import time
 
 import fitz  # PyMuPDF
-from PIL import Image
-import pytesseract
-from langdetect import detect as lang_detect, DetectorFactory
-DetectorFactory.seed = 0
 
-from . import config, chunking, vectorstore
+from . import config, chunking, manifest, pdf_extract, vectorstore
 
 log = logging.getLogger(__name__)
-_MIN_TEXT_LEN = max(1, int(getattr(config.ENV, "MIN_EXTRACTED_TEXT", 25)))
-
-def _extract_page_text(doc: fitz.Document, page_index: int) -> str:
-    page = doc.load_page(page_index)
-    try:
-        text = page.get_text("text")
-    except Exception:
-        text = page.get_text()
-    return (text or "").strip()
-
-def _ocr_page(doc: fitz.Document, page_index: int) -> str:
-    page = doc.load_page(page_index)
-    dpi_scale = float(getattr(config.ENV, "OCR_DPI_SCALE", 2.0))
-    mat = fitz.Matrix(dpi_scale, dpi_scale)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    with Image.open(io.BytesIO(pix.tobytes("png"))) as img:
-        text = pytesseract.image_to_string(img, lang=config.ENV.TESSERACT_LANGS or "eng")
-    return (text or "").strip()
 
 def _split_into_chunks(text: str) -> List[str]:
     try:
@@ -55,61 +34,227 @@ def _split_into_chunks(text: str) -> List[str]:
                     out.append(p[i:i+max_chars])
         return out
 
-def ingest_pdf(path: Path | str) -> Tuple[str, int]:
+# ---------- Streaming pipeline ----------
+_DONE = object()
+
+def _iter_queue(q: queue.Queue, stop: threading.Event) -> Iterator:
+    while True:
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _pipeline(source: Iterator, *stages: Callable[[Iterator], Iterator], maxsize: int = 8) -> Iterator:
+    """
+    Run ``source`` and each stage in its own thread, linked by bounded
+    queues, and yield the last stage's output. A full queue blocks the
+    stage feeding it (backpressure), so memory stays flat regardless of
+    input size. The first exception in any stage stops the pipeline and
+    is re-raised here.
+    """
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    queues = [queue.Queue(maxsize=max(1, maxsize)) for _ in range(len(stages) + 1)]
+
+    def run(it: Iterator, out: queue.Queue) -> None:
+        try:
+            for item in it:
+                if not _put(out, item, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+            _put(out, _DONE, stop)
+
+    threads = [threading.Thread(target=run, args=(source, queues[0]), daemon=True)]
+    for i, stage in enumerate(stages):
+        threads.append(threading.Thread(
+            target=run, args=(stage(_iter_queue(queues[i], stop)), queues[i + 1]), daemon=True,
+        ))
+    for t in threads:
+        t.start()
+    try:
+        yield from _iter_queue(queues[-1], stop)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+def _batched(items: Iterator[List], size: int) -> Iterator[List]:
+    buf: List = []
+    for part in items:
+        buf.extend(part)
+        while len(buf) >= size:
+            yield buf[:size]
+            buf = buf[size:]
+    if buf:
+        yield buf
+
+def _page_chunks(source: str, page_no: int, raw: str, lang: str | None) -> List[vectorstore.Chunk]:
+    return [
+        vectorstore.Chunk(
+            id=None,
+            text=chunk_text,
+            source=source,
+            page=page_no,
+            headings=None,
+            language=lang,
+            standard_code=None,
+            embedding=None,
+        )
+        for chunk_text in _split_into_chunks(raw)
+    ]
+
+def ingest_pdf(
+    path: Path | str,
+    force: bool = False,
+    sha256: str | None = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[str, int]:
+    """
+    Ingest one PDF against the ingest manifest. Unchanged files (same
+    size+mtime, or same content hash) chunked with the current
+    CHUNK_TOKENS/CHUNK_OVERLAP are skipped; a different chunking re-chunks
+    every page. For changed files only pages whose extracted text differs
+    are re-chunked and upserted, and chunks of pages that changed or
+    disappeared are deleted. ``force``
+    re-chunks every page. ``progress(pages_done, page_total)`` is called
+    as pages come out of extraction. Returns (filename, chunks upserted).
+    """
     path = Path(path)
+    st = path.stat()
+    old = manifest.get(path.name)
+    chunking_sig = [config.ENV.CHUNK_TOKENS, config.ENV.CHUNK_OVERLAP]
+
+    if old and not force and old.get("chunking") == chunking_sig:
+        if old.get("size") == st.st_size and old.get("mtime") == st.st_mtime:
+            log.info("INGEST SKIP (unchanged): %s", path.name)
+            return (path.name, 0)
+        sha256 = sha256 or manifest.file_sha256(path)
+        if old.get("sha256") == sha256:
+            log.info("INGEST SKIP (same content): %s", path.name)
+            manifest.touch(path.name, st.st_size, st.st_mtime)
+            return (path.name, 0)
+    sha256 = sha256 or manifest.file_sha256(path)
+
+    # page-level reuse only when the previous chunks were cut the same way
+    reuse = old if (old and not force and old.get("chunking") == chunking_sig) else {}
+    old_hashes = reuse.get("page_hashes") or {}
+    old_ids = reuse.get("chunk_ids") or {}
+
     t0 = time.time()
     log.info("INGEST START: %s", path.name)
 
     with fitz.open(str(path)) as doc:
         page_total = doc.page_count
-        all_chunks: List[vectorstore.Chunk] = []
-        ocr_pages = 0
-
-        for i in range(page_total):
-            raw = _extract_page_text(doc, i)
-            if len(raw) < _MIN_TEXT_LEN:
-                try:
-                    ocr_text = _ocr_page(doc, i)
-                    if ocr_text:
-                        raw = ocr_text
-                        ocr_pages += 1
-                except Exception as e:
-                    log.warning("OCR failed on %s p.%d: %s", path.name, i + 1, e)
+    page_hashes: Dict[str, str] = {}
+    chunk_ids: Dict[str, List[str]] = {}
+    stats = {"ocr_pages": 0, "kept_pages": 0}
+
+    def chunk_stage(pages: Iterator) -> Iterator[List[vectorstore.Chunk]]:
+        for i, raw, lang, ocr_used in pages:
+            stats["ocr_pages"] += int(ocr_used)
+            key = str(i + 1)
+            if progress is not None:
+                progress(i + 1, page_total)
+            page_hashes[key] = manifest.text_sha256(raw)
+            if old_hashes.get(key) == page_hashes[key] and key in old_ids:
+                chunk_ids[key] = old_ids[key]
+                stats["kept_pages"] += 1
+                continue
             if not raw:
+                chunk_ids[key] = []
                 continue
+            chunks = _page_chunks(path.name, i + 1, raw, lang)
+            chunk_ids[key] = list(dict.fromkeys(vectorstore.chunk_id(c) for c in chunks))
+            yield chunks
 
-            try:
-                lang = lang_detect(raw[:4000])
-            except Exception:
-                lang = None
-
-            for chunk_text in _split_into_chunks(raw):
-                all_chunks.append(
-                    vectorstore.Chunk(
-                        id=None,
-                        text=chunk_text,
-                        source=path.name,
-                        page=i + 1,
-                        headings=None,
-                        language=lang,
-                        standard_code=None,
-                        embedding=None,
-                    )
-                )
-
-        count = vectorstore.upsert_chunks(all_chunks)
-        took = time.time() - t0
-        log.info(
-            "INGEST DONE: %s | pages=%d, ocr_pages=%d, chunks_upserted=%d, took=%.3fs",
-            path.name, page_total, ocr_pages, count, took
-        )
+    def embed_stage(chunk_lists: Iterator) -> Iterator[List[vectorstore.Chunk]]:
+        for batch in _batched(chunk_lists, max(1, config.ENV.EMBED_BATCH)):
+            yield vectorstore.embed_chunks(batch)
+
+    # extract/OCR (process pool, page order) -> chunk -> embed micro-batches -> Chroma upserts
+    count = 0
+    embedded = _pipeline(
+        pdf_extract.iter_pages(str(path), page_total),
+        chunk_stage,
+        embed_stage,
+        maxsize=config.ENV.INGEST_QUEUE_SIZE,
+    )
+    for batch in _batched(embedded, max(1, config.ENV.INGEST_UPSERT_BATCH)):
+        count += vectorstore.upsert_chunks(batch)
+    ocr_pages, kept_pages = stats["ocr_pages"], stats["kept_pages"]
+
+    live = {cid for ids in chunk_ids.values() for cid in ids}
+    if manifest.file_sha256(path) != sha256:
+        # replaced while we read it: pages may come from both versions. Drop
+        # what this run added and leave the manifest for the next ingest.
+        previous = set(manifest.chunk_ids(old)) if old else set()
+        vectorstore.delete_ids([cid for cid in live if cid not in previous])
+        raise RuntimeError(f"{path.name} changed during ingest; re-ingest it")
+    stale = [cid for cid in manifest.chunk_ids(old) if cid not in live] if old else []
+    removed = vectorstore.delete_ids(stale)
+
+    manifest.put(path.name, {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "sha256": sha256,
+        "pages": page_total,
+        "chunking": chunking_sig,
+        "page_hashes": page_hashes,
+        "chunk_ids": chunk_ids,
+        "ingested_at": time.time(),
+    })
+    took = time.time() - t0
+    log.info(
+        "INGEST DONE: %s | pages=%d, unchanged_pages=%d, ocr_pages=%d, chunks_upserted=%d, chunks_removed=%d, took=%.3fs",
+        path.name, page_total, kept_pages, ocr_pages, count, removed, took
+    )
     return (path.name, count)
 
-def ingest_all_pdfs() -> List[Tuple[str, int]]:
+def forget(filename: str) -> int:
+    """Drop a source file's vectors and manifest entry."""
+    removed = vectorstore.delete_by_source(filename)
+    manifest.remove(filename)
+    return removed
+
+def prune_deleted() -> List[Tuple[str, int]]:
+    """Remove vectors of manifest files that no longer exist on disk."""
+    present = {p.name for p in config.SOURCE_PDFS.glob("*.pdf")}
+    out: List[Tuple[str, int]] = []
+    for name in manifest.names():
+        if name not in present:
+            removed = forget(name)
+            log.info("INGEST PRUNE: %s | chunks_removed=%d", name, removed)
+            out.append((name, removed))
+    return out
+
+def ingest_all_pdfs(force: bool = False) -> List[Tuple[str, int]]:
+    prune_deleted()
     paths = sorted([p for p in config.SOURCE_PDFS.glob("*.pdf")])
     out: List[Tuple[str, int]] = []
     for p in paths:
-        out.append(ingest_pdf(p))
+        out.append(ingest_pdf(p, force=force))
     return out
 
 def ingest_specific_files(files: List[Path]) -> List[Tuple[str, int]]:
@@ -0,0 +1,347 @@
+# app/services/jobs.py
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+import ctypes
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from . import config, ingest_service, manifest
+
+log = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------
+# Background ingest jobs
+# ---------------------------------------------------------------------
+# Jobs live in PROCESSED_DIR/jobs.sqlite3, so pending work survives a
+# restart. Worker threads claim the highest-priority pending job with a
+# conditional UPDATE; that is atomic across threads and uvicorn workers, so
+# a job runs exactly once even when several processes share the database.
+# A claimed job records its owner ("<pid>:<boot id>") and gets a heartbeat
+# every HEARTBEAT_SECONDS from a timer thread, independent of ingest
+# progress. A running job goes back to pending when its owner is gone
+# (checked at start and periodically by idle workers), when its heartbeat is
+# stale (backstop for pid reuse), or when its own worker is stopped.
+
+JOBS_DB = config.PROCESSED_DIR / "jobs.sqlite3"
+KINDS = ("ingest_all", "ingest_files")
+STALE_SECONDS = 120.0
+HEARTBEAT_SECONDS = 15.0
+SWEEP_SECONDS = 30.0
+OWNER = f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+
+_local = threading.local()
+_wake = threading.Event()
+_stop: Optional[threading.Event] = None
+_threads: List[threading.Thread] = []
+_current: Dict[str, str] = {}  # worker thread name -> running job id
+_current_lock = threading.Lock()
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(str(JOBS_DB), timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL,"
+            " priority INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL,"
+            " progress TEXT, result TEXT, error TEXT,"
+            " created REAL NOT NULL, started REAL, finished REAL, heartbeat REAL)"
+        )
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in cols:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority DESC, created)")
+        _local.conn = conn
+    return conn
+
+def _row(r: sqlite3.Row | None) -> Optional[Dict[str, Any]]:
+    if r is None:
+        return None
+    d = dict(r)
+    for k in ("params", "progress", "result"):
+        d[k] = json.loads(d[k]) if d.get(k) else None
+    d.pop("heartbeat", None)
+    d.pop("owner", None)
+    return d
+
+# ---------- Public API ----------
+def submit(kind: str, params: Dict[str, Any] | None = None, priority: int = 0) -> Dict[str, Any]:
+    """Queue a job and return its record immediately. Higher priority runs first."""
+    if kind not in KINDS:
+        raise ValueError(f"unknown job kind {kind!r}")
+    job_id = uuid.uuid4().hex
+    _db().execute(
+        "INSERT INTO jobs (id, kind, params, priority, status, created) VALUES (?, ?, ?, ?, 'pending', ?)",
+        (job_id, kind, json.dumps(params or {}), int(priority), time.time()),
+    )
+    _wake.set()
+    return get(job_id)
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    return _row(_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+def list_jobs(status: str | None = None, limit: int = 50) -> List[Dict[str, Any]]:
+    if status:
+        rows = _db().execute(
+            "SELECT * FROM jobs WHERE status = ? ORDER BY created DESC LIMIT ?", (status, limit)
+        ).fetchall()
+    else:
+        rows = _db().execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+    return [_row(r) for r in rows]
+
+def file_busy(name: str) -> bool:
+    """True while a queued or running job will read SOURCE_PDFS/``name``
+    (an ingest_files job listing it, or a running ingest_all)."""
+    for r in _db().execute("SELECT kind, status, params FROM jobs WHERE status IN ('pending', 'running')"):
+        if r["kind"] == "ingest_all":
+            if r["status"] == "running":
+                return True
+        elif name in (json.loads(r["params"] or "{}").get("files") or []):
+            return True
+    return False
+
+def cancel(job_id: str) -> bool:
+    """Cancel a job that has not started yet."""
+    cur = _db().execute(
+        "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'pending'",
+        (time.time(), job_id),
+    )
+    if cur.rowcount != 1:
+        return False
+    job = get(job_id)
+    for name, sha in ((job and job["params"] or {}).get("sha256") or {}).items():
+        manifest.release_upload(sha, name)  # let the same bytes be uploaded again
+    return True
+
+# ---------- Workers ----------
+def _owner_alive(owner: Optional[str]) -> bool:
+    if not owner:
+        return False
+    pid_s, _, boot = owner.partition(":")
+    try:
+        pid = int(pid_s)
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return boot == OWNER.partition(":")[2]  # same pid after a reload is a new owner
+    return _pid_alive(pid)
+
+if sys.platform == "win32":
+    _PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    _STILL_ACTIVE = 259
+    _ERROR_ACCESS_DENIED = 5
+
+    def _pid_alive(pid: int) -> bool:
+        # os.kill(pid, 0) on Windows sends CTRL_C_EVENT; ask the kernel instead
+        k32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        k32.OpenProcess.restype = ctypes.c_void_p
+        h = k32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not h:
+            return ctypes.get_last_error() == _ERROR_ACCESS_DENIED  # exists, not ours
+        try:
+            code = ctypes.c_ulong()
+            if not k32.GetExitCodeProcess(ctypes.c_void_p(h), ctypes.byref(code)):
+                return True
+            return code.value == _STILL_ACTIVE
+        finally:
+            k32.CloseHandle(ctypes.c_void_p(h))
+else:
+    def _pid_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass  # EPERM: exists, owned by another user
+        return True
+
+def _requeue_orphans() -> None:
+    """Put running jobs back to pending when their owner process is gone or
+    their heartbeat is older than STALE_SECONDS."""
+    db = _db()
+    cutoff = time.time() - STALE_SECONDS
+    orphans = [
+        r["id"] for r in db.execute("SELECT id, owner, heartbeat, started FROM jobs WHERE status = 'running'")
+        if not _owner_alive(r["owner"]) or (r["heartbeat"] or r["started"] or 0) < cutoff
+    ]
+    n = 0
+    for job_id in orphans:
+        n += db.execute(
+            "UPDATE jobs SET status = 'pending', started = NULL, owner = NULL WHERE id = ? AND status = 'running'",
+            (job_id,),
+        ).rowcount
+    if n:
+        log.info("[jobs] re-queued %d interrupted job(s)", n)
+
+def _claim() -> Optional[Dict[str, Any]]:
+    db = _db()
+    while True:
+        r = db.execute(
+            "SELECT id FROM jobs WHERE status = 'pending' ORDER BY priority DESC, created LIMIT 1"
+        ).fetchone()
+        if r is None:
+            return None
+        now = time.time()
+        won = db.execute(
+            "UPDATE jobs SET status = 'running', started = ?, heartbeat = ?, owner = ? "
+            "WHERE id = ? AND status = 'pending'",
+            (now, now, OWNER, r["id"]),
+        ).rowcount
+        if won:
+            return get(r["id"])
+
+class _Progress:
+    """Collects progress from the ingest pipeline; writes it (and the
+    heartbeat) to the database at most once a second."""
+
+    def __init__(self, job_id: str, files_total: int):
+        self.job_id = job_id
+        self.state: Dict[str, Any] = {"files_total": files_total, "files_done": 0,
+                                      "current": None, "pages_done": 0, "pages_total": 0}
+        self._last = 0.0
+
+    def update(self, force: bool = False, **kw) -> None:
+        self.state.update(kw)
+        now = time.time()
+        if force or now - self._last >= 1.0:
+            self._last = now
+            _db().execute("UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ?",
+                          (json.dumps(self.state), now, self.job_id))
+
+    def pages(self, done: int, total: int) -> None:
+        self.update(pages_done=done, pages_total=total)
+
+def _heartbeat(job_id: str, done: threading.Event) -> None:
+    """Keep a running job's heartbeat fresh while it runs, also through
+    long steps that report no page progress (prune, OCR, BM25 folds)."""
+    while not done.wait(HEARTBEAT_SECONDS):
+        try:
+            _db().execute(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = 'running' AND owner = ?",
+                (time.time(), job_id, OWNER),
+            )
+        except Exception as e:
+            log.warning("[jobs] heartbeat failed for %s: %s", job_id, e)
+
+class _Stopped(Exception):
+    """The worker was stopped between files; the job has been re-queued."""
+
+def _run(job: Dict[str, Any], stop: threading.Event) -> Dict[str, Any]:
+    params = job["params"] or {}
+    force = bool(params.get("force", False))
+    hashes: Dict[str, str] = params.get("sha256") or {}  # computed during upload
+    removed: List[Dict[str, Any]] = []
+    if job["kind"] == "ingest_all":
+        removed = [{"filename": n, "chunks_removed": c} for n, c in ingest_service.prune_deleted()]
+        files = sorted(config.SOURCE_PDFS.glob("*.pdf"))
+    else:
+        files = [Path(config.SOURCE_PDFS) / name for name in params.get("files", [])]
+
+    progress = _Progress(job["id"], len(files))
+    ingested: List[Dict[str, Any]] = []
+    for idx, p in enumerate(files):
+        if stop.is_set():
+            raise _Stopped()
+        progress.update(force=True, current=p.name, files_done=idx, pages_done=0, pages_total=0)
+        try:
+            name, count = ingest_service.ingest_pdf(
+                p, force=force, sha256=hashes.get(p.name), progress=progress.pages,
+            )
+            ingested.append({"filename": name, "chunks_upserted": count})
+        except Exception as e:
+            log.exception("[jobs] ingest failed for %s", p.name)
+            ingested.append({"filename": p.name, "error": str(e)})
+        if p.name in hashes:
+            manifest.release_upload(hashes[p.name], p.name)  # now in the manifest (or failed)
+    progress.update(force=True, current=None, files_done=len(files))
+    return {
+        "ingested": ingested,
+        "removed": removed,
+        "total_chunks": sum(i.get("chunks_upserted", 0) for i in ingested),
+    }
+
+def _finish(job_id: str, status: str, result: Dict | None = None, error: str | None = None) -> None:
+    # only if this process still owns the job (stop() may have re-queued it)
+    _db().execute(
+        "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? "
+        "WHERE id = ? AND status = 'running' AND owner = ?",
+        (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, OWNER),
+    )
+
+def _worker(stop: threading.Event) -> None:
+    me = threading.current_thread().name
+    last_sweep = time.monotonic()
+    while not stop.is_set():
+        if time.monotonic() - last_sweep >= SWEEP_SECONDS:
+            last_sweep = time.monotonic()
+            try:
+                _requeue_orphans()
+            except Exception as e:
+                log.warning("[jobs] sweep failed: %s", e)
+        try:
+            job = _claim()
+        except Exception as e:
+            log.warning("[jobs] claim failed: %s", e)
+            job = None
+        if job is None:
+            _wake.wait(timeout=max(0.1, config.ENV.JOB_POLL_SECONDS))
+            _wake.clear()
+            continue
+        log.info("[jobs] start %s (%s)", job["id"], job["kind"])
+        with _current_lock:
+            _current[me] = job["id"]
+        beat_done = threading.Event()
+        threading.Thread(target=_heartbeat, args=(job["id"], beat_done),
+                         name=f"{me}-heartbeat", daemon=True).start()
+        try:
+            result = _run(job, stop)
+            _finish(job["id"], "done", result=result)
+            log.info("[jobs] done %s", job["id"])
+        except _Stopped:
+            log.info("[jobs] stopped during %s; re-queued", job["id"])
+        except Exception as e:
+            log.exception("[jobs] failed %s", job["id"])
+            _finish(job["id"], "failed", error=str(e))
+        finally:
+            beat_done.set()
+            with _current_lock:
+                _current.pop(me, None)
+
+def start() -> None:
+    """Resume interrupted jobs and start JOB_WORKERS worker threads."""
+    global _stop
+    if _threads:
+        return
+    _stop = threading.Event()
+    _requeue_orphans()
+    for i in range(max(1, config.ENV.JOB_WORKERS)):
+        t = threading.Thread(target=_worker, args=(_stop,), name=f"ingest-job-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+def stop() -> None:
+    """Stop taking new jobs and put this process's running jobs back to
+    pending; their workers give up before the next file."""
+    if _stop is not None:
+        _stop.set()
+    _wake.set()
+    with _current_lock:
+        running = list(_current.values())
+    for job_id in running:
+        _db().execute(
+            "UPDATE jobs SET status = 'pending', started = NULL, owner = NULL "
+            "WHERE id = ? AND status = 'running' AND owner = ?",
+            (job_id, OWNER),
+        )
+    if running:
+        log.info("[jobs] re-queued %d running job(s) on stop", len(running))
+    _threads.clear()
@@ -1,9 +1,17 @@
 # app/services/llm.py
 from __future__ import annotations
+import logging
 import os
-from typing import Generator
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Iterator, List, Optional
 from . import config
 
+log = logging.getLogger(__name__)
+
 def _build_messages(system: str, context: str, user_query: str):
     """
     Build messages for the LLM with explicit instructions:
@@ -28,57 +36,439 @@ def _build_messages(system: str, context: str, user_query: str):
         )}
     ]
 
+# ---------- Providers ----------
+# One long-lived provider per name, each owning a pooled HTTP client, so
+# calls reuse keep-alive connections instead of a new TLS handshake per
+# question. Providers only make single attempts; deadlines, retries and
+# hedging are handled by generate/stream_chat below.
+
+class _Provider:
+    name = "base"
+
+    def complete(self, messages: List[Dict], timeout: float) -> str:
+        raise NotImplementedError
+
+    def stream(self, messages: List[Dict], timeout: float,
+               on_open: Optional[Callable[[Callable[[], None]], None]] = None) -> Iterator[str]:
+        """Yield content deltas; closing the generator closes the response.
+        ``on_open`` receives a thread-safe function that aborts the response
+        (used to stop the losing attempt of a hedged call)."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class OpenAIProvider(_Provider):
+    """OpenAI chat completions (or any compatible server via OPENAI_BASE_URL)."""
+    name = "openai"
+
+    def __init__(self):
+        try:
+            import httpx
+            from openai import OpenAI
+        except Exception as e:
+            raise RuntimeError(
+                "Missing package 'openai'. Install with: pip install 'openai>=1.0.0'"
+            ) from e
+        api_key = config.ENV.OPENAI_API_KEY or os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is missing in environment/.env")
+        n = max(1, config.ENV.LLM_MAX_CONNECTIONS)
+        self._http = httpx.Client(
+            limits=httpx.Limits(max_connections=n, max_keepalive_connections=n, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(config.ENV.LLM_TIMEOUT_S, connect=5.0),
+        )
+        self._client = OpenAI(api_key=api_key, base_url=config.ENV.OPENAI_BASE_URL or None,
+                              http_client=self._http, max_retries=0)
+
+    def complete(self, messages: List[Dict], timeout: float) -> str:
+        resp = self._client.chat.completions.create(
+            model=config.ENV.OPENAI_MODEL,
+            messages=messages,
+            temperature=0.2,
+            timeout=timeout,
+        )
+        return (resp.choices[0].message.content or "").strip()
+
+    def stream(self, messages: List[Dict], timeout: float,
+               on_open: Optional[Callable[[Callable[[], None]], None]] = None) -> Iterator[str]:
+        stream = self._client.chat.completions.create(
+            model=config.ENV.OPENAI_MODEL,
+            messages=messages,
+            temperature=0.2,
+            stream=True,
+            timeout=timeout,
+        )
+        if on_open is not None:
+            on_open(stream.close)
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = getattr(chunk.choices[0].delta, "content", None)
+                if delta:
+                    yield delta
+        finally:
+            stream.close()
+
+    def close(self) -> None:
+        self._http.close()
+
+
+def stub_reply(messages: List[Dict]) -> List[str]:
+    """Deterministic answer deltas for the stub provider: echoes the question
+    and the opening of the first context snippet, word by word."""
+    user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    question = user.split("User question:", 1)[-1].split("\n", 1)[0].strip()
+    context = user.split("\n", 1)[-1].split("\n\nUser question:", 1)[0]
+    first = next((ln for ln in context.splitlines() if ln.strip() and not ln.startswith("[")), "")
+    text = f"Stub answer to: {question} Based on the retrieved context: {' '.join(first.split()[:60])}"
+    words = text.split(" ")
+    return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+class StubProvider(_Provider):
+    """Offline provider with OpenAI-like pacing (LLM_STUB_TTFT_MS before the
+    first delta, LLM_STUB_TOKEN_MS per delta); for load tests and demos."""
+    name = "stub"
+
+    def complete(self, messages: List[Dict], timeout: float) -> str:
+        return "".join(self.stream(messages, timeout)).strip()
+
+    def stream(self, messages: List[Dict], timeout: float,
+               on_open: Optional[Callable[[Callable[[], None]], None]] = None) -> Iterator[str]:
+        closed = threading.Event()
+        if on_open is not None:
+            on_open(closed.set)
+        if closed.wait(config.ENV.LLM_STUB_TTFT_MS / 1000.0):
+            return
+        for i, delta in enumerate(stub_reply(messages)):
+            if i and closed.wait(config.ENV.LLM_STUB_TOKEN_MS / 1000.0):
+                return
+            yield delta
+
+
+PROVIDERS = {"openai": OpenAIProvider, "stub": StubProvider}
+_providers: Dict[str, _Provider] = {}
+_providers_lock = threading.Lock()
+
+def provider_name() -> str:
+    return (config.ENV.LLM_PROVIDER or "openai").lower()
+
+def get_provider(name: Optional[str] = None) -> _Provider:
+    name = (name or provider_name()).lower()
+    p = _providers.get(name)
+    if p is None:
+        with _providers_lock:
+            p = _providers.get(name)
+            if p is None:
+                if name not in PROVIDERS:
+                    raise RuntimeError(f"Unknown LLM_PROVIDER {name!r}; expected one of {sorted(PROVIDERS)}")
+                p = _providers[name] = PROVIDERS[name]()
+    return p
+
+def shutdown() -> None:
+    with _providers_lock:
+        for p in _providers.values():
+            try:
+                p.close()
+            except Exception as e:
+                log.warning("Closing LLM provider %s failed: %s", p.name, e)
+        _providers.clear()
+    if _hedge_pool is not None:
+        _hedge_pool.shutdown(wait=False, cancel_futures=True)
+
+# ---------- Deadlines, retries, hedging ----------
+_RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_RETRY_NAMES = {"APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError"}
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    return type(e).__name__ in _RETRY_NAMES or getattr(e, "status_code", None) in _RETRY_STATUS
+
+def _backoff(attempt: int) -> float:
+    # full jitter: uniform in [0, base * 2^attempt]
+    return random.uniform(0.0, config.ENV.LLM_RETRY_BASE_MS / 1000.0 * (2 ** attempt))
+
+class _Latency:
+    """Recent successful call latencies (full completions, or time to first
+    delta for streams); the completion p95 is the hedge delay."""
+
+    def __init__(self, size: int = 200):
+        self._lat = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._lat.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._lat) < 20:
+                return None
+            xs = sorted(self._lat)
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+_latency: Dict[str, _Latency] = {}
+_stats = {"calls": 0, "streams": 0, "retries": 0, "errors": 0, "hedged": 0, "hedge_wins": 0,
+          "hedge_skipped": 0, "cancelled": 0}
+_stats_lock = threading.Lock()
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedges_inflight = 0
+
+def _bump(key: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += n
+
+def _lat(name: str) -> _Latency:
+    return _latency.setdefault(name, _Latency())
+
+def _timeout(deadline: float) -> float:
+    return max(0.1, min(config.ENV.LLM_TIMEOUT_S, deadline - time.monotonic()))
+
+def _attempt(p: _Provider, messages: List[Dict], deadline: float) -> str:
+    t0 = time.perf_counter()
+    text = p.complete(messages, timeout=_timeout(deadline))
+    _lat(p.name).add(time.perf_counter() - t0)
+    return text
+
+class _Race:
+    """A hedged call: the primary runs on the caller's thread, at most one
+    duplicate on the hedge pool. The first complete answer wins and aborts
+    the other attempt's response."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.winner = ""
+        self.closers: Dict[str, Callable[[], None]] = {}
+        self.hedge: Optional[Future] = None
+
+    def opened(self, who: str, close: Callable[[], None]) -> None:
+        with self.lock:
+            lost = self.done.is_set()
+            if not lost:
+                self.closers[who] = close
+        if lost:
+            close()
+
+    def finish(self, who: str, text: str) -> bool:
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.result, self.winner = text, who
+            self.done.set()
+            losers = [c for w, c in self.closers.items() if w != who]
+        for close in losers:
+            try:
+                close()
+            except Exception:
+                pass
+        return True
+
+def _race_attempt(p: _Provider, messages: List[Dict], deadline: float, race: _Race, who: str) -> None:
+    """Stream one attempt to completion unless the other one wins first."""
+    t0 = time.perf_counter()
+    parts: List[str] = []
+    it = p.stream(messages, timeout=_timeout(deadline), on_open=lambda close: race.opened(who, close))
+    try:
+        for delta in it:
+            if race.done.is_set():
+                return
+            parts.append(delta)
+    except Exception:
+        if race.done.is_set():
+            return  # aborted by the winner
+        raise
+    finally:
+        it.close()
+    if race.finish(who, "".join(parts).strip()):
+        _lat(p.name).add(time.perf_counter() - t0)
+
+def _launch_hedge(p: _Provider, messages: List[Dict], deadline: float, race: _Race) -> None:
+    global _hedge_pool, _hedges_inflight
+    with _stats_lock:
+        # at most LLM_HEDGE_RATIO of calls, and never queue behind a busy pool
+        over = _stats["hedged"] + 1 > config.ENV.LLM_HEDGE_RATIO * _stats["calls"]
+        busy = _hedges_inflight >= max(1, config.ENV.LLM_MAX_CONNECTIONS)
+        if race.done.is_set() or over or busy:
+            if not race.done.is_set():
+                _stats["hedge_skipped"] += 1
+            return
+        _stats["hedged"] += 1
+        _hedges_inflight += 1
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=max(1, config.ENV.LLM_MAX_CONNECTIONS),
+                                             thread_name_prefix="llm-hedge")
+
+    def run() -> None:
+        global _hedges_inflight
+        try:
+            _race_attempt(p, messages, deadline, race, "hedge")
+        finally:
+            with _stats_lock:
+                _hedges_inflight -= 1
+
+    fut = _hedge_pool.submit(run)
+    with race.lock:
+        race.hedge = fut
+
+def _hedged(p: _Provider, messages: List[Dict], deadline: float) -> str:
+    """Primary attempt on the caller's thread; if it is still running after
+    this provider's p95 latency, race one duplicate and take whichever
+    answers first."""
+    p95 = _lat(p.name).quantile(0.95)
+    if not config.ENV.LLM_HEDGE or p95 is None:
+        return _attempt(p, messages, deadline)
+    race = _Race()
+    timer = threading.Timer(max(p95, config.ENV.LLM_HEDGE_MIN_MS / 1000.0),
+                            _launch_hedge, args=(p, messages, deadline, race))
+    timer.daemon = True
+    timer.start()
+    try:
+        _race_attempt(p, messages, deadline, race, "primary")
+    except Exception:
+        # the primary failed: fall back to a hedge that is already running
+        timer.cancel()
+        with race.lock:
+            hedge = race.hedge
+        if hedge is None:
+            raise
+        try:
+            hedge.result(timeout=max(0.0, deadline - time.monotonic()))
+        except Exception:
+            pass
+        if not race.done.is_set():
+            raise
+    finally:
+        timer.cancel()
+    race.done.wait(timeout=max(0.0, deadline - time.monotonic()))
+    if not race.done.is_set():
+        raise TimeoutError("LLM deadline exceeded")
+    if race.winner == "hedge":
+        _bump("hedge_wins")
+    return race.result or ""
+
 def generate(system: str, context: str, user_query: str) -> str:
     """
-    Generate a non-streamed response using the configured LLM provider.
+    Generate a non-streamed response using the configured LLM provider,
+    retrying transient failures with jittered backoff until LLM_DEADLINE_S.
     """
-    try:
-        from openai import OpenAI
-    except Exception as e:
-        raise RuntimeError(
-            "Missing package 'openai'. Install with: pip install 'openai>=1.0.0'"
-        ) from e
+    p = get_provider()
+    messages = _build_messages(system, context, user_query)
+    deadline = time.monotonic() + config.ENV.LLM_DEADLINE_S
+    _bump("calls")
+    attempt = 0
+    while True:
+        try:
+            return _hedged(p, messages, deadline)
+        except Exception as e:
+            pause = _backoff(attempt)
+            if attempt >= config.ENV.LLM_RETRIES or not _retryable(e) or time.monotonic() + pause >= deadline:
+                _bump("errors")
+                raise
+            attempt += 1
+            _bump("retries")
+            log.warning("LLM call failed (%s); retry %d in %.2fs", e, attempt, pause)
+            time.sleep(pause)
 
-    api_key = config.ENV.OPENAI_API_KEY or os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is missing in environment/.env")
+class CancelToken:
+    """``threading.Event``-like cancel flag for :func:`stream_chat`. Setting
+    it also aborts the upstream response registered by the running attempt,
+    so a disconnect during connect or before the first token cuts the call
+    at once instead of when the next delta arrives."""
 
-    client = OpenAI(api_key=api_key)
-    messages = _build_messages(system, context, user_query)
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._closer: Optional[Callable[[], None]] = None
 
-    resp = client.chat.completions.create(
-        model=config.ENV.OPENAI_MODEL,
-        messages=messages,
-        temperature=0.2,
-    )
-    return (resp.choices[0].message.content or "").strip()
+    def is_set(self) -> bool:
+        return self._event.is_set()
 
-def stream_chat(system: str, context: str, user_query: str) -> Generator[str, None, None]:
+    def set(self) -> None:
+        with self._lock:
+            self._event.set()
+            closer, self._closer = self._closer, None
+        if closer is not None:
+            try:
+                closer()
+            except Exception as e:
+                log.debug("Closing cancelled LLM response failed: %s", e)
+
+    def register(self, closer: Optional[Callable[[], None]]) -> None:
+        """Make ``closer`` the abort for the current attempt (None clears);
+        called at once when already cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._closer = closer
+                return
+        if closer is not None:
+            closer()
+
+def stream_chat(system: str, context: str, user_query: str,
+                cancel: CancelToken | threading.Event | None = None) -> Generator[str, None, None]:
     """
     Stream the response token-by-token using the configured LLM provider.
+    Failures before the first delta are retried like :func:`generate`.
+    Setting ``cancel`` (e.g. on client disconnect) stops the stream; a
+    :class:`CancelToken` also closes the upstream response immediately,
+    a plain Event only after the current delta.
     """
-    try:
-        from openai import OpenAI
-    except Exception as e:
-        raise RuntimeError(
-            "Missing package 'openai'. Install with: pip install 'openai>=1.0.0'"
-        ) from e
-
-    api_key = config.ENV.OPENAI_API_KEY or os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is missing in environment/.env")
-
-    client = OpenAI(api_key=api_key)
+    p = get_provider()
     messages = _build_messages(system, context, user_query)
+    deadline = time.monotonic() + config.ENV.LLM_DEADLINE_S
+    register = getattr(cancel, "register", None)
+    _bump("streams")
+    attempt = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            _bump("cancelled")
+            return
+        started = False
+        t0 = time.perf_counter()
+        stream = p.stream(messages, timeout=_timeout(deadline), on_open=register)
+        try:
+            for delta in stream:
+                if cancel is not None and cancel.is_set():
+                    _bump("cancelled")
+                    return
+                if not started:
+                    started = True
+                    _lat(p.name + "_ttft").add(time.perf_counter() - t0)
+                yield delta
+            if cancel is not None and cancel.is_set():
+                _bump("cancelled")  # aborted before the next delta
+            return
+        except Exception as e:
+            if cancel is not None and cancel.is_set():
+                _bump("cancelled")  # the abort surfaces as a read error
+                return
+            pause = _backoff(attempt)
+            if (started or attempt >= config.ENV.LLM_RETRIES or not _retryable(e)
+                    or time.monotonic() + pause >= deadline):
+                _bump("errors")
+                raise
+            attempt += 1
+            _bump("retries")
+            log.warning("LLM stream failed before first token (%s); retry %d in %.2fs", e, attempt, pause)
+            time.sleep(pause)
+        finally:
+            if register is not None:
+                register(None)
+            stream.close()
 
-    stream = client.chat.completions.create(
-        model=config.ENV.OPENAI_MODEL,
-        messages=messages,
-        temperature=0.2,
-        stream=True,
-    )
-
-    for chunk in stream:
-        delta = getattr(chunk.choices[0].delta, "content", None)
-        if delta:
-            yield delta
+def stats() -> Dict:
+    with _stats_lock:
+        st = dict(_stats)
+    st["provider"] = provider_name()
+    st["model"] = config.ENV.OPENAI_MODEL
+    st["connected"] = sorted(_providers)
+    for name, lat in list(_latency.items()):
+        p50, p95 = lat.quantile(0.5), lat.quantile(0.95)
+        st[f"{name}_p50_ms"] = round(p50 * 1000.0, 1) if p50 is not None else None
+        st[f"{name}_p95_ms"] = round(p95 * 1000.0, 1) if p95 is not None else None
+    return st
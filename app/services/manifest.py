@@ -0,0 +1,206 @@
+# app/services/manifest.py
+from __future__ import annotations
+from typing import Dict, List, Optional
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------
+# Ingest manifest
+# ---------------------------------------------------------------------
+# PROCESSED_DIR/ingest_manifest.sqlite3, shared by all workers (WAL).
+#   files   one row per source file:
+#             size, mtime, sha256   change detection (size+mtime first, hash to confirm)
+#             pages                 page count
+#             chunking              [CHUNK_TOKENS, CHUNK_OVERLAP] the chunks were cut with
+#             ingested_at           unix time
+#   pages   one row per (file, page): sha256 of the extracted page text and
+#           the chunk ids upserted for that page
+#   uploads uploaded content hashes queued for ingest but not in files yet,
+#           so concurrent uploads of the same bytes are ingested once
+# Lookups touch only the rows they need, and every write is one transaction,
+# so concurrent jobs in different processes never lose each other's entries.
+
+DB_PATH = config.PROCESSED_DIR / "ingest_manifest.sqlite3"
+LEGACY_JSON = config.PROCESSED_DIR / "ingest_manifest.json"
+# an upload claim whose file never reached SOURCE_PDFS is abandoned after this
+CLAIM_GRACE_SECONDS = 60.0
+
+def file_sha256(path: Path | str, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(block), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = False
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(str(DB_PATH), timeout=30.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " name TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT,"
+            " pages INTEGER, chunking TEXT, ingested_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " name TEXT NOT NULL, page TEXT NOT NULL, hash TEXT, chunk_ids TEXT NOT NULL,"
+            " PRIMARY KEY (name, page))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " sha256 TEXT PRIMARY KEY, name TEXT NOT NULL, claimed REAL NOT NULL)"
+        )
+        _local.conn = conn
+        _migrate(conn)
+    return conn
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """One-time import of the old JSON manifest."""
+    global _migrated
+    with _migrate_lock:
+        if _migrated or not LEGACY_JSON.exists():
+            _migrated = True
+            return
+        try:
+            with open(LEGACY_JSON, "r", encoding="utf-8") as f:
+                files = (json.load(f) or {}).get("files") or {}
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for name, entry in files.items():
+                    if conn.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is None:
+                        _write(conn, name, entry)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            os.replace(LEGACY_JSON, LEGACY_JSON.with_name(LEGACY_JSON.name + ".migrated"))
+            log.info("Ingest manifest: imported %d file(s) from %s", len(files), LEGACY_JSON.name)
+        except FileNotFoundError:
+            pass  # another worker migrated it first
+        except Exception as e:
+            log.warning("Could not import legacy ingest manifest %s: %s", LEGACY_JSON, e)
+        _migrated = True
+
+def _write(conn: sqlite3.Connection, name: str, entry: Dict) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO files (name, size, mtime, sha256, pages, chunking, ingested_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (name, entry.get("size"), entry.get("mtime"), entry.get("sha256"), entry.get("pages"),
+         json.dumps(entry.get("chunking")), entry.get("ingested_at")),
+    )
+    conn.execute("DELETE FROM pages WHERE name = ?", (name,))
+    hashes = entry.get("page_hashes") or {}
+    ids = entry.get("chunk_ids") or {}
+    conn.executemany(
+        "INSERT INTO pages (name, page, hash, chunk_ids) VALUES (?, ?, ?, ?)",
+        [(name, page, hashes.get(page), json.dumps(ids.get(page) or [])) for page in sorted(set(hashes) | set(ids))],
+    )
+
+def get(name: str) -> Optional[Dict]:
+    db = _db()
+    r = db.execute(
+        "SELECT size, mtime, sha256, pages, chunking, ingested_at FROM files WHERE name = ?", (name,)
+    ).fetchone()
+    if r is None:
+        return None
+    page_hashes: Dict[str, str] = {}
+    chunk_ids: Dict[str, List[str]] = {}
+    for page, h, ids in db.execute("SELECT page, hash, chunk_ids FROM pages WHERE name = ?", (name,)):
+        if h is not None:
+            page_hashes[page] = h
+        chunk_ids[page] = json.loads(ids)
+    return {
+        "size": r[0],
+        "mtime": r[1],
+        "sha256": r[2],
+        "pages": r[3],
+        "chunking": json.loads(r[4]) if r[4] else None,
+        "ingested_at": r[5],
+        "page_hashes": page_hashes,
+        "chunk_ids": chunk_ids,
+    }
+
+def names() -> List[str]:
+    return [n for (n,) in _db().execute("SELECT name FROM files ORDER BY name")]
+
+def put(name: str, entry: Dict) -> None:
+    """Replace a file's entry, page rows included, in one transaction."""
+    db = _db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        _write(db, name, entry)
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+def touch(name: str, size: int, mtime: float) -> None:
+    """Record a new size/mtime for unchanged content (page rows untouched)."""
+    _db().execute("UPDATE files SET size = ?, mtime = ? WHERE name = ?", (size, mtime, name))
+
+def remove(name: str) -> Optional[Dict]:
+    entry = get(name)
+    if entry is None:
+        return None
+    db = _db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM pages WHERE name = ?", (name,))
+        db.execute("DELETE FROM files WHERE name = ?", (name,))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return entry
+
+def find_by_sha256(sha: str) -> List[str]:
+    """Names of manifest files with this content hash."""
+    return [n for (n,) in _db().execute("SELECT name FROM files WHERE sha256 = ? ORDER BY name", (sha,))]
+
+# ---------- Upload claims ----------
+def claim_upload(sha: str, name: str) -> Optional[str]:
+    """
+    Reserve ``sha`` for an upload saved as ``name`` until its ingest
+    finishes. Returns the name of the upload already holding it, or None
+    when the claim is ours. A claim whose file is missing from SOURCE_PDFS
+    after CLAIM_GRACE_SECONDS is taken over.
+    """
+    db = _db()
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        r = db.execute("SELECT name, claimed FROM uploads WHERE sha256 = ?", (sha,)).fetchone()
+        if r is not None and (now - r[1] < CLAIM_GRACE_SECONDS or (config.SOURCE_PDFS / r[0]).exists()):
+            db.execute("COMMIT")
+            return r[0]
+        db.execute("INSERT OR REPLACE INTO uploads (sha256, name, claimed) VALUES (?, ?, ?)", (sha, name, now))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return None
+
+def release_upload(sha: str, name: str) -> None:
+    _db().execute("DELETE FROM uploads WHERE sha256 = ? AND name = ?", (sha, name))
+
+def chunk_ids(entry: Dict) -> List[str]:
+    return [cid for ids in (entry.get("chunk_ids") or {}).values() for cid in ids]
@@ -1,14 +1,56 @@
+# app/services/ocr.py
+from __future__ import annotations
 from typing import Optional
 import pytesseract
 from PIL import Image
 import fitz
-from app.services import config
+from . import config
+
+def _native_dpi(page: "fitz.Page") -> Optional[float]:
+    """Effective resolution (px per inch) of the sharpest raster image placed
+    on the page, or None if the page has no raster images."""
+    best: Optional[float] = None
+    for img in page.get_images(full=True):
+        xref, width_px = img[0], img[2]
+        try:
+            rects = page.get_image_rects(xref)
+        except Exception:
+            rects = []
+        for r in rects:
+            if r.width > 1:
+                dpi = width_px / (r.width / 72.0)
+                best = dpi if best is None else max(best, dpi)
+    return best
+
+def render_dpi(page: "fitz.Page") -> Optional[float]:
+    """
+    DPI to render ``page`` at for OCR, or None when there is nothing to OCR:
+    a page without raster images is blank or vector-only, and its text (if
+    any) was already available to get_text().
+    """
+    if not page.get_images():
+        return None
+    native = _native_dpi(page)
+    if native is None:
+        return 72.0 * float(getattr(config.ENV, "OCR_DPI_SCALE", 2.0))
+    lo = float(getattr(config.ENV, "OCR_MIN_DPI", 150))
+    hi = float(getattr(config.ENV, "OCR_MAX_DPI", 300))
+    # rendering above the scan's own resolution only costs time
+    return min(max(native, lo), hi)
 
 def ocr_page(page: "fitz.Page") -> str:
-    dpi = float(getattr(config.ENV, "OCR_DPI_SCALE", 2.0))
-    mat = fitz.Matrix(dpi, dpi)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    dpi = render_dpi(page)
+    if dpi is None:
+        return ""
+    zoom = dpi / 72.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    # wrap the pixmap's samples without copying them into PIL; pytesseract
+    # still writes the image to a temp file and runs the tesseract CLI on it,
+    # which is why the render DPI is capped. pix must outlive img.
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+    lo, hi = img.getextrema()
+    if hi - lo < 16:
+        return ""  # blank scan
     lang = getattr(config.ENV, "TESSERACT_LANGS", "eng") or "eng"
     text = pytesseract.image_to_string(img, lang=lang)
-    return text or ""
+    return (text or "").strip()
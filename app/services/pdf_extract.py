@@ -0,0 +1,124 @@
+# app/services/pdf_extract.py
+"""
+Page text extraction + OCR, run in a bounded process pool.
+
+Kept free of vectorstore/embeddings imports: pool workers import this module,
+and it must stay cheap to load (Windows spawns fresh interpreters).
+"""
+from __future__ import annotations
+from typing import Iterator, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+import threading
+
+import fitz  # PyMuPDF
+from langdetect import detect as lang_detect, DetectorFactory
+DetectorFactory.seed = 0
+
+from . import config, ocr
+
+log = logging.getLogger(__name__)
+_MIN_TEXT_LEN = max(1, int(getattr(config.ENV, "MIN_EXTRACTED_TEXT", 25)))
+
+# (page_index, text, language, ocr_used)
+PageResult = Tuple[int, str, Optional[str], bool]
+
+def _extract_page_text(doc: fitz.Document, page_index: int) -> str:
+    page = doc.load_page(page_index)
+    try:
+        text = page.get_text("text")
+    except Exception:
+        text = page.get_text()
+    return (text or "").strip()
+
+def extract_pages(path: str, pages: List[int]) -> List[PageResult]:
+    """Extract text for ``pages`` of one PDF, OCR-ing pages with too little
+    embedded text, and detect each page's language."""
+    out: List[PageResult] = []
+    name = os.path.basename(path)
+    with fitz.open(path) as doc:
+        for i in pages:
+            raw = _extract_page_text(doc, i)
+            ocr_used = False
+            if len(raw) < _MIN_TEXT_LEN:
+                try:
+                    ocr_text = ocr.ocr_page(doc.load_page(i))
+                    if ocr_text:
+                        raw = ocr_text
+                        ocr_used = True
+                except Exception as e:
+                    log.warning("OCR failed on %s p.%d: %s", name, i + 1, e)
+            lang = None
+            if raw:
+                try:
+                    lang = lang_detect(raw[:4000])
+                except Exception:
+                    lang = None
+            out.append((i, raw, lang, ocr_used))
+    return out
+
+# ---------- Process pool ----------
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+def worker_count() -> int:
+    n = int(getattr(config.ENV, "INGEST_WORKERS", 0) or 0)
+    if n <= 0:
+        n = max(1, (os.cpu_count() or 2) - 1)
+    return n
+
+def _init_worker() -> None:
+    # one Tesseract thread per process; the pool provides the parallelism
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server process has live threads (jobs,
+            # LLM pool, torch) whose locks a forked child could inherit held
+            _pool = ProcessPoolExecutor(
+                max_workers=worker_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pool
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def iter_pages(path: str, page_total: int) -> Iterator[PageResult]:
+    """Yield extracted pages of ``path`` in page order. Batches of pages run
+    in the process pool with at most 2x workers batches in flight."""
+    per_task = max(1, int(getattr(config.ENV, "INGEST_PAGES_PER_TASK", 4)))
+    batches = [list(range(s, min(s + per_task, page_total))) for s in range(0, page_total, per_task)]
+    workers = worker_count()
+    if workers <= 1 or len(batches) <= 1:
+        for b in batches:
+            yield from extract_pages(path, b)
+        return
+
+    pool = _get_pool()
+    pending: deque[Future] = deque()
+    todo = iter(batches)
+    try:
+        for b in todo:
+            pending.append(pool.submit(extract_pages, path, b))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            res = pending.popleft().result()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append(pool.submit(extract_pages, path, nxt))
+            yield from res
+    finally:
+        for f in pending:
+            f.cancel()
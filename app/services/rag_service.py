@@ -1,64 +1,211 @@
 # app/services/rag_service.py
 from __future__ import annotations
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 import textwrap
+import threading
+import time
 
-from . import config, vectorstore, expand, embeddings, llm
+from . import answer_cache, cache, compress, config, context_pack, fusion, vectorstore, expand, embeddings, llm, rerank
 
-def retrieve(query: str, top_k: int = 10, filter_doc: str | None = None):
+def retrieve(query: str, top_k: int = 10, filter_doc: str | None = None, filters: Dict | None = None,
+             fusion_opts: Dict | None = None):
+    """``fusion_opts`` overrides the fusion strategy/weights for this request
+    (see fusion.params)."""
+    filters = vectorstore.make_filters(filters, source=filter_doc)
+    fp = fusion.params(fusion_opts)
+    results = cache.get_cache("retrieval", config.ENV.QUERY_CACHE_MB)
+    key = ("retrieve", cache.normalize_query(query), top_k, vectorstore.filter_key(filters), fp.key())
+    version = vectorstore.corpus_version()
+    hit = results.get(key, version)
+    if hit is not None:
+        return list(hit)
+
+    def compute():
+        ranked, degraded = _retrieve(query, top_k=top_k, filters=filters, fp=fp)
+        if not degraded:  # a fused-order fallback is retried on the next request
+            results.put(key, list(ranked), version)
+        return ranked
+
+    # identical concurrent queries share one expansion + search
+    return list(cache.get_flight("retrieve").do((key, version), compute))
+
+def _retrieve(query: str, top_k: int, filters: Dict | None, fp: fusion.FusionParams) -> Tuple[List, bool]:
     # expand acronyms for recall
     queries = expand.expanded_queries(query)
     all_hits = []
-    for q in queries:
-        hv = vectorstore.hybrid_search(q, topk_dense=config.ENV.TOPK_DENSE, topk_bm25=config.ENV.TOPK_BM25)
+    for hv in vectorstore.hybrid_search_many(queries, topk_dense=config.ENV.TOPK_DENSE,
+                                             topk_bm25=config.ENV.TOPK_BM25, filters=filters,
+                                             fusion_params=fp):
         all_hits.extend(hv)
-    # de-dup by (source,page)
+    # de-dup by (source,page), keeping the best fused score
     uniq = {}
-    def blended(h): return config.ENV.HYBRID_WEIGHT_DENSE*h.score_vec + config.ENV.HYBRID_WEIGHT_BM25*h.score_bm25
     for h in all_hits:
-        if filter_doc and h.source != filter_doc:
-            continue
         key = (h.source, h.page)
-        if key not in uniq or blended(h) > blended(uniq[key]):
+        if key not in uniq or h.score > uniq[key].score:
             uniq[key] = h
-    ranked = sorted(uniq.values(), key=blended, reverse=True)
-    ranked = vectorstore.mmr_diverse(ranked, top_k=min(top_k, config.ENV.TOPK_AFTER_MMR), lambda_mult=config.ENV.MMR_LAMBDA)
-    return ranked
-
-def build_context(hits) -> Tuple[str, List[Dict]]:
-    # format as numbered snippets with citations
-    pieces = []
-    cits: List[Dict] = []
-    for i, h in enumerate(hits, start=1):
-        txt = h.text.strip().replace("\n", " ").strip()
-        pieces.append(f"[{i}] Source: {h.source} (p.{h.page})\n{txt}")
-        cits.append({"n": i, "source": h.source, "page": h.page})
-    context = "\n\n".join(pieces)
-    return context, cits
-
-def answer(query: str, top_k: int = 10, max_context_chars: int = 6000, filter_doc: str | None = None) -> Dict:
-    hits = retrieve(query, top_k=top_k, filter_doc=filter_doc)
-    context, cits = build_context(hits)
+    ranked = sorted(uniq.values(), key=lambda h: h.score, reverse=True)
+    return diversify(query, ranked, top_k=min(top_k, config.ENV.TOPK_AFTER_MMR))
+
+def diversify(query: str, ranked, top_k: int) -> Tuple[List, bool]:
+    """Cross-encoder rerank of the fused head (when enabled and within its
+    latency budget), then MMR driven by the reranker scores. Returns (hits,
+    degraded); degraded means the reranker fell back to the fused order and
+    the result should not be cached."""
+    ranked, scores, degraded = rerank.rerank(query, ranked)
+    if scores is None:
+        return vectorstore.mmr_diverse(ranked, top_k=top_k, lambda_mult=config.ENV.MMR_LAMBDA), degraded
+    head, tail = ranked[:len(scores)], ranked[len(scores):]
+    lo, hi = float(scores.min()), float(scores.max())
+    rel = (scores - lo) / (hi - lo + 1e-6)
+    picked = vectorstore.mmr_diverse(head, top_k=top_k, lambda_mult=config.ENV.MMR_LAMBDA, relevance=rel)
+    return picked + tail[: max(0, top_k - len(picked))], False
+
+def context_budget(max_context_chars: int = 6000, max_context_tokens: int | None = None) -> int:
+    """Token budget for the LLM context: explicit tokens, else
+    CONTEXT_MAX_TOKENS, else the character budget at ~4 chars/token."""
+    return int(max_context_tokens or config.ENV.CONTEXT_MAX_TOKENS or max(1, max_context_chars // 4))
+
+def build_context(hits, max_tokens: int | None = None) -> Tuple[str, List[Dict]]:
+    # format as numbered snippets with citations, packed into the token budget
+    packed = context_pack.pack(hits, max_tokens if max_tokens is not None else context_budget())
+    return packed.context, packed.citations
+
+_NO_CONTEXT = ("I couldn't find enough context in the ingested documents. "
+               "Please upload or specify the standard/document.")
+
+def _prepare(query: str, top_k: int, max_context_chars: int, filter_doc: str | None, filters: Dict | None,
+             fusion_opts: Dict | None, max_context_tokens: int | None, compress_context: bool | None):
+    """Retrieve, optionally compress, and pack; returns (hits, packed,
+    answer-cache evidence key or None, context meta)."""
+    hits = retrieve(query, top_k=top_k, filter_doc=filter_doc, filters=filters, fusion_opts=fusion_opts)
+    budget = context_budget(max_context_chars, max_context_tokens)
+    squeeze = config.ENV.CONTEXT_COMPRESS if compress_context is None else bool(compress_context)
+    if squeeze:
+        hits = compress.compress(query, hits)
+    packed = context_pack.pack(hits, budget)
+    variant = f"compress:{config.ENV.COMPRESS_MODE}:{config.ENV.COMPRESS_KEEP}:{config.ENV.COMPRESS_NEIGHBORS}" if squeeze else ""
+    evidence = answer_cache.evidence_key([h.id for h in packed.hits], budget, variant)
+    meta = {
+        "tokens": packed.tokens,
+        "budget": packed.budget,
+        "snippets": len(packed.hits),
+        "truncated": packed.truncated,
+        "deduped": packed.deduped,
+        "dropped": packed.dropped,
+        "encoding": packed.encoding,
+        "compressed": squeeze,
+    }
+    return hits, packed, evidence, meta
+
+def _cached_answer(query: str, evidence: str):
+    """(cache, query vector, cached text or None); cache is None when off."""
+    acache = answer_cache.get_cache()
+    if acache is None:
+        return None, None, None
+    q_vec = embeddings.embed_one(query)
+    return acache, q_vec, acache.get(q_vec, evidence)
+
+def answer(query: str, top_k: int = 10, max_context_chars: int = 6000, filter_doc: str | None = None,
+           filters: Dict | None = None, fusion_opts: Dict | None = None,
+           max_context_tokens: int | None = None, compress_context: bool | None = None) -> Dict:
+    """
+    ``compress_context`` overrides CONTEXT_COMPRESS for this request.
+    Concurrent calls with the same normalized query and options against the
+    same corpus version share one retrieval and LLM call; the returned dict
+    is shared between them and must not be mutated.
+    """
+    key = (
+        "answer",
+        cache.normalize_query(query),
+        top_k,
+        vectorstore.filter_key(vectorstore.make_filters(filters, source=filter_doc)),
+        fusion.params(fusion_opts).key(),
+        context_budget(max_context_chars, max_context_tokens),
+        config.ENV.CONTEXT_COMPRESS if compress_context is None else bool(compress_context),
+        vectorstore.corpus_version(),
+    )
+    return cache.get_flight("answer").do(key, lambda: _answer(
+        query, top_k, max_context_chars, filter_doc, filters, fusion_opts, max_context_tokens, compress_context))
+
+def _answer(query: str, top_k: int, max_context_chars: int, filter_doc: str | None, filters: Dict | None,
+            fusion_opts: Dict | None, max_context_tokens: int | None, compress_context: bool | None) -> Dict:
+    hits, packed, evidence, ctx_meta = _prepare(query, top_k, max_context_chars, filter_doc, filters,
+                                                fusion_opts, max_context_tokens, compress_context)
+    context, cits, used = packed.context, packed.citations, packed.hits
     if not context.strip():
         return {
-            "answer": "I couldn't find enough context in the ingested documents. Please upload or specify the standard/document.",
+            "answer": _NO_CONTEXT,
             "citations": [],
-            "used_provider": "openai",
+            "used_provider": llm.provider_name(),
             "meta": {"hits": []},
         }
-    # Trim context to size
-    if len(context) > max_context_chars:
-        context = context[:max_context_chars] + "\n...\n"
 
-    system = config.SYSTEM_PROMPT
-    text = llm.generate(system=system, context=context, user_query=query)
+    # reuse an answer to a near-identical question over the same evidence
+    acache, q_vec, text = _cached_answer(query, evidence)
+    cached = text is not None
+
+    if text is None:
+        system = config.SYSTEM_PROMPT
+        text = llm.generate(system=system, context=context, user_query=query)
+        if acache is not None and text:
+            acache.put(q_vec, evidence, [h.id for h in used], text)
 
     return {
         "answer": text,
         "citations": cits,
-        "used_provider": "openai",
+        "used_provider": llm.provider_name(),
         "meta": {
             "hit_count": len(hits),
-            "top_sources": list({(h.source) for h in hits}),
+            "top_sources": list({(h.source) for h in used}),
+            "answer_cached": cached,
+            "context": ctx_meta,
         },
     }
+
+def answer_stream(query: str, top_k: int = 10, max_context_chars: int = 6000, filter_doc: str | None = None,
+                  filters: Dict | None = None, fusion_opts: Dict | None = None,
+                  max_context_tokens: int | None = None, compress_context: bool | None = None,
+                  cancel: llm.CancelToken | threading.Event | None = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Streaming :func:`answer`: yields ("citations", ...) as soon as the
+    context is packed, then ("token", {"t": delta}) per LLM delta, then
+    ("meta", ...) with timings. Setting ``cancel`` stops the upstream LLM
+    stream; a cancelled answer is not cached.
+    """
+    t0 = time.perf_counter()
+    hits, packed, evidence, ctx_meta = _prepare(query, top_k, max_context_chars, filter_doc, filters,
+                                                fusion_opts, max_context_tokens, compress_context)
+    used = packed.hits
+    t_ctx = time.perf_counter()
+    yield "citations", {"citations": packed.citations, "used_provider": llm.provider_name()}
+
+    timings = {"retrieve_ms": round((t_ctx - t0) * 1000.0, 1)}
+    cached = False
+    parts: List[str] = []
+    if not packed.context.strip():
+        parts.append(_NO_CONTEXT)
+        yield "token", {"t": _NO_CONTEXT}
+    else:
+        acache, q_vec, text = _cached_answer(query, evidence)
+        cached = text is not None
+        if cached:
+            parts.append(text)
+            yield "token", {"t": text}
+        else:
+            for delta in llm.stream_chat(system=config.SYSTEM_PROMPT, context=packed.context,
+                                         user_query=query, cancel=cancel):
+                if not parts:
+                    timings["first_token_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+                parts.append(delta)
+                yield "token", {"t": delta}
+            text = "".join(parts).strip()
+            if acache is not None and text and not (cancel is not None and cancel.is_set()):
+                acache.put(q_vec, evidence, [h.id for h in used], text)
+    timings["total_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    yield "meta", {
+        "hit_count": len(hits),
+        "top_sources": list({(h.source) for h in used}),
+        "answer_cached": cached,
+        "context": ctx_meta,
+        "timings": timings,
+    }
@@ -0,0 +1,130 @@
+# app/services/rerank.py
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import cache, config
+
+log = logging.getLogger(__name__)
+
+# ---------- Cross-encoder reranking ----------
+# Scores the top RERANK_TOPN fused candidates against the query in one
+# batch on a single dedicated thread, so reranking never uses more than one
+# inference's worth of CPU. Each call waits at most RERANK_BUDGET_MS; past
+# that, or while an earlier batch is still running, the caller keeps the
+# fused order. Scores are cached per (query, chunk id); a batch that misses
+# its deadline still fills the cache when it finishes. Such a fallback is
+# reported as degraded so callers don't cache the fused order as final.
+# The model is loaded at startup (warmup) so the first query's budget isn't
+# spent loading it.
+
+_model = None
+_model_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+_inflight = 0
+_inflight_lock = threading.Lock()
+_stats = {"calls": 0, "reranked": 0, "timeouts": 0, "busy": 0, "errors": 0, "pairs_scored": 0,
+          "pairs_cached": 0, "total_ms": 0.0}
+
+def _load_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import CrossEncoder
+                _model = CrossEncoder(config.ENV.RERANKER_MODEL, device="cpu",
+                                      max_length=config.ENV.RERANK_MAX_TOKENS)
+    return _model
+
+def warmup() -> None:
+    """Load the cross-encoder up front (no-op when reranking is off)."""
+    if config.ENV.USE_RERANKER:
+        _load_model()
+
+def _truncate(text: str) -> str:
+    # the tokenizer truncates to max_length anyway; cutting by characters
+    # first keeps tokenization cheap for long chunks (~4 chars per token)
+    return (text or "")[: config.ENV.RERANK_MAX_TOKENS * 4]
+
+def _predict(query: str, texts: List[str]) -> np.ndarray:
+    model = _load_model()
+    pairs = [(query, _truncate(t)) for t in texts]
+    return np.asarray(model.predict(pairs, batch_size=len(pairs), show_progress_bar=False),
+                      dtype=np.float32).reshape(-1)
+
+def _score_cache():
+    return cache.get_cache("rerank_scores", config.ENV.RERANK_CACHE_MB)
+
+def rerank(query: str, hits: List) -> Tuple[List, Optional[np.ndarray], bool]:
+    """
+    Rerank the first RERANK_TOPN of ``hits`` (fused order, best first).
+    Returns (hits with the top-N reordered by cross-encoder score, those
+    N scores, False), (hits, None, False) when reranking is off, or
+    (hits, None, True) when it was skipped as busy, over budget or failed.
+    """
+    global _inflight
+    if not config.ENV.USE_RERANKER or len(hits) < 2:
+        return hits, None, False
+    t0 = time.perf_counter()
+    _stats["calls"] += 1
+    top, rest = hits[: max(1, config.ENV.RERANK_TOPN)], hits[max(1, config.ENV.RERANK_TOPN):]
+    sc = _score_cache()
+    qkey = (config.ENV.RERANKER_MODEL, cache.normalize_query(query))
+    scores = np.empty(len(top), dtype=np.float32)
+    todo: List[int] = []
+    for i, h in enumerate(top):
+        s = sc.get((qkey, h.id))
+        if s is None:
+            todo.append(i)
+        else:
+            scores[i] = s
+    _stats["pairs_cached"] += len(top) - len(todo)
+
+    if todo:
+        with _inflight_lock:
+            if _inflight >= 1:
+                _stats["busy"] += 1
+                return hits, None, True
+            _inflight += 1
+        ids = [top[i].id for i in todo]
+        fut: Future = _executor.submit(_predict, query, [top[i].text for i in todo])
+
+        def _done(f: Future) -> None:
+            global _inflight
+            with _inflight_lock:
+                _inflight -= 1
+            if f.exception() is None:
+                for _id, s in zip(ids, f.result().tolist()):
+                    sc.put((qkey, _id), float(s))
+                _stats["pairs_scored"] += len(ids)
+
+        fut.add_done_callback(_done)
+        budget = config.ENV.RERANK_BUDGET_MS / 1000.0 - (time.perf_counter() - t0)
+        try:
+            new = fut.result(timeout=max(0.0, budget))
+        except FutureTimeout:
+            _stats["timeouts"] += 1
+            log.info("Rerank over budget (%d ms); keeping fused order", config.ENV.RERANK_BUDGET_MS)
+            return hits, None, True
+        except Exception as e:
+            _stats["errors"] += 1
+            log.warning("Rerank failed (%s); keeping fused order", e)
+            return hits, None, True
+        scores[todo] = new
+
+    order = np.argsort(-scores, kind="stable")
+    _stats["reranked"] += 1
+    _stats["total_ms"] += (time.perf_counter() - t0) * 1000.0
+    return [top[i] for i in order] + list(rest), scores[order], False
+
+def stats() -> Dict:
+    st = dict(_stats)
+    st["enabled"] = config.ENV.USE_RERANKER
+    st["mean_ms"] = round(st.pop("total_ms") / st["reranked"], 2) if st["reranked"] else 0.0
+    return st
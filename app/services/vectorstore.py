@@ -4,16 +4,16 @@ from __future__ import annotations
 import hashlib
 import logging
 import re
+import threading
 import time
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import chromadb
 import numpy as np
 from chromadb.config import Settings
-from rank_bm25 import BM25Okapi
 
-from . import config, embeddings
+from . import bm25, config, docstore, embed_cache, embeddings, fusion
 
 log = logging.getLogger(__name__)
 
@@ -37,6 +37,8 @@ class SearchHit:
     page: int
     score_vec: float
     score_bm25: float
+    score: float = 0.0  # fused hybrid score, computed once in hybrid_search_many
+    embedding: Optional[np.ndarray] = None  # stored chunk vector, for MMR
 
 # ---------- Helpers ----------
 def _meta_primitive(v):
@@ -49,11 +51,6 @@ def _meta_primitive(v):
             return str(list(v))
     return str(v)
 
-def _tokenize(s: str) -> List[str]:
-    if not s:
-        return []
-    return [t for t in s.lower().split() if t.strip()]
-
 def _deterministic_id(source: str, page: int, text: str) -> str:
     h = hashlib.sha256()
     h.update((source or "").encode("utf-8"))
@@ -61,6 +58,9 @@ def _deterministic_id(source: str, page: int, text: str) -> str:
     h.update((text or "")[:1024].encode("utf-8"))
     return h.hexdigest()[:32]
 
+def chunk_id(c: "Chunk") -> str:
+    return (c.id or _deterministic_id(c.source, c.page, c.text or "")).strip()
+
 def _parse_max_batch_from_msg(msg: str) -> int | None:
     m = re.search(r"max batch size of (\d+)", msg)
     return int(m.group(1)) if m else None
@@ -82,31 +82,93 @@ def _get_collection():
         )
 
 # ---------- BM25 index ----------
-_BM25: Optional[BM25Okapi] = None
-_BM25_IDS: List[str] = []
-_BM25_TEXTS: List[str] = []
+# Persisted under VECTOR_DIR/bm25 and memory-mapped, so workers share it.
+_BM25 = bm25.BM25Index(path=config.VECTOR_DIR / "bm25")
 
-def rebuild_bm25_index() -> None:
-    global _BM25, _BM25_IDS, _BM25_TEXTS
+def _iter_collection(include: List[str], page_size: int = 1000):
     coll = _get_collection()
-    _BM25_IDS, _BM25_TEXTS = [], []
-
     offset = 0
-    page_size = 1000
     while True:
-        res = coll.get(limit=page_size, offset=offset, include=["documents"])
-        ids = res.get("ids", [])
-        docs = res.get("documents", [])
-        if not ids:
+        res = coll.get(limit=page_size, offset=offset, include=include)
+        if not res.get("ids", []):
             break
-        _BM25_IDS.extend(ids)
-        _BM25_TEXTS.extend(docs)
-        offset += len(ids)
+        yield res
+        offset += len(res["ids"])
+
+# ---------- Corpus version ----------
+# Bumped on every upsert/delete/wipe in this worker, and when BM25 sync
+# applies changes journaled by another worker. Caches of derived results
+# store the version they were computed against.
+_corpus_version = 0
+_version_lock = threading.Lock()
+
+def _bump_corpus_version() -> None:
+    global _corpus_version
+    with _version_lock:
+        _corpus_version += 1
+
+# Listeners get the chunk ids that were upserted or deleted in this worker
+# (None = everything, e.g. wipe), for caches keyed by chunk.
+_change_listeners: List[Callable[[Optional[List[str]]], None]] = []
+
+def add_change_listener(fn: Callable[[Optional[List[str]]], None]) -> None:
+    _change_listeners.append(fn)
+
+def _changed(ids: Optional[List[str]]) -> None:
+    _bump_corpus_version()
+    for fn in list(_change_listeners):
+        try:
+            fn(ids)
+        except Exception as e:
+            log.warning("Change listener %r failed: %s", fn, e)
+
+def _sync() -> None:
+    if _BM25.sync():
+        _bump_corpus_version()
+
+def corpus_version() -> int:
+    _sync()
+    return _corpus_version
+
+def term_idf(terms: List[str]) -> Dict[str, float]:
+    """BM25 idf of ``terms`` over the live corpus."""
+    return _BM25.idf(terms)
+
+def open_bm25_index() -> None:
+    """Open the persisted BM25 index; rebuild from Chroma if missing or
+    written by an incompatible format version."""
+    if not _BM25.open():
+        rebuild_bm25_index()
+
+def open_docstore() -> None:
+    """Rebuild the local docstore from Chroma if their sizes disagree
+    (first start, or a crash between the two writes)."""
+    store, n = docstore.get_store(), _get_collection().count()
+    if len(store) != n:
+        log.info("Docstore out of sync (%d vs %d in Chroma); rebuilding", len(store), n)
+        store.rebuild(
+            (res["ids"], res.get("documents", []), res.get("metadatas", []))
+            for res in _iter_collection(["documents", "metadatas"])
+        )
 
-    corpus = [_tokenize(t) for t in _BM25_TEXTS]
-    _BM25 = BM25Okapi(corpus) if corpus else None
+def rebuild_bm25_index() -> None:
+    """Full rebuild from Chroma (startup / recovery). Upserts and deletes
+    update the index incrementally and do not call this."""
+    _BM25.rebuild(
+        (res["ids"], res.get("documents", []), res.get("metadatas", []))
+        for res in _iter_collection(["documents", "metadatas"])
+    )
+    _bump_corpus_version()
 
 # ---------- Public API ----------
+def embed_chunks(chunks: List[Chunk]) -> List[Chunk]:
+    """Fill in missing ``embedding``s in place (cache first, then the model)."""
+    todo = [c for c in chunks if c.embedding is None]
+    if todo:
+        for c, v in zip(todo, embed_cache.embed_cached([c.text or "" for c in todo])):
+            c.embedding = v
+    return chunks
+
 def upsert_chunks(chunks: List[Chunk]) -> int:
     if not chunks:
         return 0
@@ -130,7 +192,7 @@ def upsert_chunks(chunks: List[Chunk]) -> int:
     seen_ids = set()
 
     for c in uniq_chunks:
-        cid = (c.id or _deterministic_id(c.source, c.page, c.text or "")).strip()
+        cid = chunk_id(c)
         if cid in seen_ids:
             continue
         seen_ids.add(cid)
@@ -153,7 +215,8 @@ def upsert_chunks(chunks: List[Chunk]) -> int:
             vecs.append(c.embedding)
 
     if missing_texts:
-        new_vecs = embeddings.embed(missing_texts)
+        # only texts never embedded with this model reach the model
+        new_vecs = embed_cache.embed_cached(missing_texts)
         j = 0
         for i in range(len(vecs)):
             if vecs[i] is None:
@@ -187,7 +250,9 @@ def upsert_chunks(chunks: List[Chunk]) -> int:
             else:
                 raise
 
-    rebuild_bm25_index()
+    docstore.get_store().put_many(ids, docs, metas)
+    _BM25.add(ids, docs, metas)
+    _changed(ids)
     return len(ids)
 
 def delete_by_source(source_filename: str) -> int:
@@ -196,7 +261,20 @@ def delete_by_source(source_filename: str) -> int:
     ids = res.get("ids", []) if isinstance(res, dict) else []
     if ids:
         coll.delete(ids=ids)
-    rebuild_bm25_index()
+        docstore.get_store().delete(ids)
+        _BM25.remove(ids)
+        _changed(ids)
+    return len(ids)
+
+def delete_ids(ids: List[str]) -> int:
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return 0
+    coll = _get_collection()
+    coll.delete(ids=ids)
+    docstore.get_store().delete(ids)
+    _BM25.remove(ids)
+    _changed(ids)
     return len(ids)
 
 def wipe() -> None:
@@ -204,7 +282,9 @@ def wipe() -> None:
         _client.delete_collection(_COLLECTION_NAME)
     except Exception:
         pass
-    rebuild_bm25_index()
+    docstore.get_store().clear()
+    _BM25.clear()
+    _changed(None)
 
 def list_sources() -> List[Dict]:
     coll = _get_collection()
@@ -217,107 +297,198 @@ def list_sources() -> List[Dict]:
         "sample_sources": list({m.get("source") for m in metas}) if metas else [],
     }]
 
-def hybrid_search(query: str, topk_dense: int, topk_bm25: int) -> List[SearchHit]:
+# ---------- Filters ----------
+# {"source": ..., "page": ..., "language": ...}; each value is a scalar or a
+# list of allowed values. Applied inside retrieval: Chroma ``where`` on the
+# dense side, a doc bitset on the BM25 side.
+FILTER_FIELDS = ("source", "page", "language")
+
+def make_filters(filters: Optional[Dict] = None, **kw) -> Optional[Dict]:
+    """Normalize a filter dict (plus keyword overrides); None if empty."""
+    out: Dict = {}
+    for k, v in {**(filters or {}), **kw}.items():
+        if v is None or v == "" or v == []:
+            continue
+        if k not in FILTER_FIELDS:
+            raise ValueError(f"unsupported filter {k!r}; expected one of {FILTER_FIELDS}")
+        if isinstance(v, (list, tuple, set)):
+            v = sorted({int(x) if k == "page" else str(x) for x in v})
+        else:
+            v = int(v) if k == "page" else str(v)
+        out[k] = v
+    return out or None
+
+def filter_key(filters: Optional[Dict]) -> Tuple:
+    return tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in sorted((filters or {}).items()))
+
+def _chroma_where(filters: Optional[Dict]) -> Optional[Dict]:
+    if not filters:
+        return None
+    conds = [{k: {"$in": v}} if isinstance(v, list) else {k: v} for k, v in filters.items()]
+    return conds[0] if len(conds) == 1 else {"$and": conds}
+
+def _result_row(res: Dict, key: str, i: int) -> List:
+    rows = res.get(key) or []
+    return (rows[i] or []) if i < len(rows) else []
+
+def _stored_vectors(coll, ids: List[str], texts: List[str]) -> Dict[str, np.ndarray]:
+    """Stored embeddings for chunks not returned by the dense query: the
+    content-addressed embedding cache first, Chroma for the rest."""
+    out: Dict[str, np.ndarray] = {}
+    cache = embed_cache.get_cache()
+    if cache is not None and ids:
+        try:
+            for _id, v in zip(ids, cache.get_many(texts)):
+                if v is not None:
+                    out[_id] = v
+        except Exception as e:
+            log.warning("Embedding cache read failed: %s", e)
+    missing = [i for i in ids if i not in out]
+    if missing:
+        got = coll.get(ids=missing, include=["embeddings"])
+        embs = got.get("embeddings")
+        if embs is not None:
+            for _id, v in zip(got.get("ids", []), embs):
+                out[_id] = np.asarray(v, dtype=np.float32)
+    return out
+
+def hybrid_search(query: str, topk_dense: int, topk_bm25: int, filters: Optional[Dict] = None,
+                  fusion_params: Optional[fusion.FusionParams] = None) -> List[SearchHit]:
+    return hybrid_search_many([query], topk_dense=topk_dense, topk_bm25=topk_bm25, filters=filters,
+                              fusion_params=fusion_params)[0]
+
+def hybrid_search_many(queries: List[str], topk_dense: int, topk_bm25: int,
+                       filters: Optional[Dict] = None,
+                       fusion_params: Optional[fusion.FusionParams] = None) -> List[List[SearchHit]]:
+    """
+    Hybrid search for several query variants at once: one embedding batch,
+    one multi-embedding Chroma query, one BM25 pass, and a local docstore
+    lookup for the BM25-only ids of all variants. Returns one hit list per query,
+    each normalized on its own as with hybrid_search. ``filters`` (see
+    make_filters) restrict both sides, so every candidate slot is usable.
+    Scores are fused per query by ``fusion_params`` (config defaults).
+    """
+    if not queries:
+        return []
     coll = _get_collection()
-    q_vec = embeddings.embed_one(query).tolist()
+    _sync()
+    q_vecs = [v.tolist() for v in embeddings.embed_queries(queries)]
     dres = coll.query(
-        query_embeddings=[q_vec],
+        query_embeddings=q_vecs,
         n_results=topk_dense,
-        include=["documents", "metadatas", "distances"],  # no "ids" here
+        where=_chroma_where(filters),
+        include=["documents", "metadatas", "distances", "embeddings"],  # no "ids" here
     )
-
-    ids_d   = dres.get("ids", [[]])[0]
-    docs_d  = dres.get("documents", [[]])[0]
-    metas_d = dres.get("metadatas", [[]])[0]
-    dists   = dres.get("distances", [[]])[0]
-
-    dense_sims: Dict[str, float] = {}
-    dense_payload: Dict[str, Tuple[str, Dict]] = {}
-    for i, _id in enumerate(ids_d):
-        sim = 1.0 - float(dists[i]) if i < len(dists) else 0.0
-        dense_sims[_id] = sim
-        t = docs_d[i] if i < len(docs_d) else ""
-        m = metas_d[i] if i < len(metas_d) else {}
-        dense_payload[_id] = (t, m)
-
-    bm25_scores: Dict[str, float] = {}
-    if _BM25 is not None and _BM25_IDS:
-        scores = _BM25.get_scores(_tokenize(query))
-        top_idx = np.argsort(scores)[::-1][:topk_bm25]
-        for idx in top_idx:
-            bm25_scores[_BM25_IDS[idx]] = float(scores[idx])
-
-    keys: List[str] = []
-    merged: Dict[str, Dict[str, float]] = {}
-    for _id, sim in dense_sims.items():
-        if _id not in merged:
-            keys.append(_id); merged[_id] = {}
-        merged[_id]["score_vec"] = sim
-    for _id, score in bm25_scores.items():
-        if _id not in merged:
-            keys.append(_id); merged[_id] = {}
-        merged[_id]["score_bm25"] = score
-
-    dense_vals = [merged[k].get("score_vec", 0.0) for k in keys]
-    bm25_vals  = [merged[k].get("score_bm25", 0.0) for k in keys]
-    def _norm(vals: List[float]) -> List[float]:
-        if not vals:
-            return []
-        arr = np.array(vals, dtype=np.float32)
-        if float(arr.std()) < 1e-6:
-            m = arr / (abs(arr).max() + 1e-6)
-        else:
-            z = (arr - arr.mean()) / (arr.std() + 1e-6)
-            m = (z - z.min()) / (z.max() - z.min() + 1e-6)
-        return [float(v) for v in m]
-    ndense = _norm(dense_vals); nbm25 = _norm(bm25_vals)
-
-    hits: List[SearchHit] = []
-    bm25_only_ids = [k for k in keys if k not in dense_payload]
-    bm25_payload: Dict[str, Tuple[str, Dict]] = {}
+    bm25_all = _BM25.top_n_many([bm25.tokenize(q) for q in queries], topk_bm25, where=filters)
+
+    payload: Dict[str, Tuple[str, Dict]] = {}
+    vectors: Dict[str, np.ndarray] = {}
+    emb_rows = dres.get("embeddings")
+    per_query: List[Tuple[Dict[str, float], Dict[str, float]]] = []
+    for qi in range(len(queries)):
+        ids_d   = _result_row(dres, "ids", qi)
+        docs_d  = _result_row(dres, "documents", qi)
+        metas_d = _result_row(dres, "metadatas", qi)
+        dists   = _result_row(dres, "distances", qi)
+        embs_d  = emb_rows[qi] if emb_rows is not None and qi < len(emb_rows) else []
+
+        dense_sims: Dict[str, float] = {}
+        for i, _id in enumerate(ids_d):
+            sim = 1.0 - float(dists[i]) if i < len(dists) else 0.0
+            dense_sims[_id] = sim
+            t = docs_d[i] if i < len(docs_d) else ""
+            m = metas_d[i] if i < len(metas_d) else {}
+            payload[_id] = (t, m)
+            if i < len(embs_d):
+                vectors[_id] = np.asarray(embs_d[i], dtype=np.float32)
+        per_query.append((dense_sims, dict(bm25_all[qi])))
+
+    bm25_only_ids = list({k for _, bm in per_query for k in bm if k not in payload})
+    if bm25_only_ids:
+        payload.update(docstore.get_store().get_many(bm25_only_ids, version=corpus_version()))
+        bm25_only_ids = [k for k in bm25_only_ids if k not in payload]
     if bm25_only_ids:
+        # docstore lagging behind Chroma (another worker mid-upsert)
         got = coll.get(ids=bm25_only_ids, include=["documents", "metadatas"])
         for _id, text, meta in zip(got.get("ids", []), got.get("documents", []), got.get("metadatas", [])):
-            bm25_payload[_id] = (text, meta)
-
-    for i, _id in enumerate(keys):
-        dv = ndense[i] if i < len(ndense) else 0.0
-        bv = nbm25[i] if i < len(nbm25) else 0.0
-        if _id in dense_payload:
-            text, meta = dense_payload[_id]
-        else:
-            text, meta = bm25_payload.get(_id, ("", {}))
-        source = meta.get("source", "") if isinstance(meta, dict) else ""
-        page = int(meta.get("page", 0)) if isinstance(meta, dict) else 0
-        hits.append(SearchHit(id=_id, text=text or "", source=source, page=page, score_vec=dv, score_bm25=bv))
-    return hits
-
-def mmr_diverse(hits: List[SearchHit], top_k: int, lambda_mult: float = 0.6) -> List[SearchHit]:
-    def blended(h: SearchHit) -> float:
-        return config.ENV.HYBRID_WEIGHT_DENSE * h.score_vec + config.ENV.HYBRID_WEIGHT_BM25 * h.score_bm25
-    selected: List[SearchHit] = []; used = set()
-    pool = sorted(hits, key=blended, reverse=True)
-    while pool and len(selected) < top_k:
-        best = None; best_val = -1e9
-        for h in pool:
-            sim_penalty = (1.0 - lambda_mult) * 0.4 if (h.source, h.page) in used else 0.0
-            val = lambda_mult * blended(h) - sim_penalty
-            if val > best_val:
-                best, best_val = h, val
-        if not best: break
-        selected.append(best); used.add((best.source, best.page)); pool.remove(best)
-    return selected
+            payload[_id] = (text, meta)
+    no_vec = [k for k in payload if k not in vectors]
+    if no_vec:
+        vectors.update(_stored_vectors(coll, no_vec, [payload[k][0] or "" for k in no_vec]))
+
+    fp = fusion_params or fusion.params()
+    nan = float("nan")
+    out: List[List[SearchHit]] = []
+    for dense_sims, bm25_scores in per_query:
+        keys: List[str] = list(dense_sims)
+        keys.extend(k for k in bm25_scores if k not in dense_sims)
+        dense = np.fromiter((dense_sims.get(k, nan) for k in keys), dtype=np.float32, count=len(keys))
+        sparse = np.fromiter((bm25_scores.get(k, nan) for k in keys), dtype=np.float32, count=len(keys))
+        nd, nb, fused = fusion.fuse(dense, sparse, fp)
+
+        hits: List[SearchHit] = []
+        for i, _id in enumerate(keys):
+            text, meta = payload.get(_id, ("", {}))
+            source = meta.get("source", "") if isinstance(meta, dict) else ""
+            page = int(meta.get("page", 0)) if isinstance(meta, dict) else 0
+            hits.append(SearchHit(id=_id, text=text or "", source=source, page=page,
+                                  score_vec=float(nd[i]), score_bm25=float(nb[i]), score=float(fused[i]),
+                                  embedding=vectors.get(_id)))
+        out.append(hits)
+    return out
+
+def mmr_diverse(hits: List[SearchHit], top_k: int, lambda_mult: float = 0.6,
+                relevance: Optional[np.ndarray] = None) -> List[SearchHit]:
+    """
+    Maximal marginal relevance over the hits' stored embeddings: each pick
+    maximizes ``lambda * relevance - (1 - lambda) * max cosine similarity``
+    to the hits already picked. Similarities come from one matrix product;
+    the running max is updated with one row per pick. Hits from the same
+    (source, page) count as duplicates even without embeddings. Relevance
+    defaults to the fused hybrid score (``SearchHit.score``); pass ``relevance`` (one value per
+    hit, roughly 0..1) to use e.g. reranker scores instead.
+    """
+    n = len(hits)
+    if n == 0 or top_k <= 0:
+        return []
+    if relevance is not None:
+        rel = np.asarray(relevance, dtype=np.float32)
+    else:
+        rel = np.fromiter((h.score for h in hits), dtype=np.float32, count=n)
+    dims = {h.embedding.shape[-1] for h in hits if h.embedding is not None}
+    if len(dims) == 1:
+        d = dims.pop()
+        emb = np.zeros((n, d), dtype=np.float32)
+        for i, h in enumerate(hits):
+            if h.embedding is not None:
+                emb[i] = h.embedding
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12
+        sim = emb @ emb.T
+    else:
+        sim = np.zeros((n, n), dtype=np.float32)
+    _, page_code = np.unique([f"{h.source}\x00{h.page}" for h in hits], return_inverse=True)
+    sim[page_code[:, None] == page_code[None, :]] = 1.0
+
+    max_sim = np.zeros(n, dtype=np.float32)
+    taken = np.zeros(n, dtype=bool)
+    picked: List[int] = []
+    for _ in range(min(top_k, n)):
+        score = lambda_mult * rel - (1.0 - lambda_mult) * max_sim
+        score[taken] = -np.inf
+        j = int(np.argmax(score))
+        picked.append(j)
+        taken[j] = True
+        np.maximum(max_sim, sim[j], out=max_sim)
+    return [hits[j] for j in picked]
 
 def query(q_or_emb, top_k: int = 10, filter_doc: str | None = None):
     coll = _get_collection()
+    filters = make_filters(source=filter_doc)
     if isinstance(q_or_emb, str):
-        hits = hybrid_search(q_or_emb, topk_dense=config.ENV.TOPK_DENSE, topk_bm25=config.ENV.TOPK_BM25)
+        hits = hybrid_search(q_or_emb, topk_dense=config.ENV.TOPK_DENSE, topk_bm25=config.ENV.TOPK_BM25,
+                             filters=filters)
         hits = mmr_diverse(hits, top_k=top_k, lambda_mult=config.ENV.MMR_LAMBDA)
-        if filter_doc:
-            hits = [h for h in hits if h.source == filter_doc]
-        def blended(h: SearchHit) -> float:
-            return config.ENV.HYBRID_WEIGHT_DENSE * h.score_vec + config.ENV.HYBRID_WEIGHT_BM25 * h.score_bm25
-        scores = np.array([blended(h) for h in hits], dtype=np.float32)
+        scores = np.fromiter((h.score for h in hits), dtype=np.float32, count=len(hits))
         if len(scores) > 0:
             smin, smax = float(scores.min()), float(scores.max())
             norm = (scores - smin) / (smax - smin + 1e-6)
@@ -332,5 +503,5 @@ def query(q_or_emb, top_k: int = 10, filter_doc: str | None = None):
         query_embeddings=[q_vec],
         n_results=top_k,
         include=["documents", "metadatas", "distances"],
-        where={"source": filter_doc} if filter_doc else None,
+        where=_chroma_where(filters),
     )